@@ -0,0 +1,187 @@
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Admission control for generations. Every query costs OpenAI quota, a
+# render and an upload, so create_query asks Admission first and answers
+# 429 with a Retry-After when a user or the whole service is over its
+# rate or too many generations are already in flight. Admitted queries
+# wait in a FairQueue that serves users in turn.
+
+
+class TokenBucket:
+    '''
+    Allows `rate` events per second on average with bursts of up to
+    `burst`, not thread safe on its own
+    '''
+
+    def __init__(self, rate, burst):
+        '''
+        Initialize a full TokenBucket
+        '''
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        '''
+        Seconds until a token is available, 0 if one is now
+        '''
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+class Admission:
+    '''
+    Per-user and global token buckets plus a cap on in-flight generations,
+    in_flight being a function returning the current number
+    '''
+
+    def __init__(self, user_rate, user_burst, global_rate, global_burst,
+                 max_in_flight, in_flight, retry_after=5.0, max_users=10000):
+        '''
+        Initialize an Admission, retry_after is the delay suggested when
+        the in-flight cap is reached. Full user buckets are forgotten once
+        more than max_users are tracked.
+        '''
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_in_flight = max_in_flight
+        self.in_flight = in_flight
+        self.retry_after = retry_after
+        self.max_users = max_users
+        self.lock = threading.Lock()
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.user_buckets = {}
+        self.admitted = 0
+        self.rejected = {"user_rate": 0, "global_rate": 0, "in_flight": 0}
+
+    def admit(self, user_id):
+        '''
+        Admit a generation for a user, returning None if admitted or the
+        reason it was not and the seconds to wait before retrying
+        '''
+        now = time.monotonic()
+        with self.lock:
+            if self.in_flight() >= self.max_in_flight:
+                return self.reject("in_flight", self.retry_after)
+            bucket = self.user_buckets.get(user_id)
+            if bucket is None:
+                if len(self.user_buckets) >= self.max_users:
+                    self.forget(now)
+                bucket = self.user_buckets[user_id] = TokenBucket(
+                    self.user_rate, self.user_burst)
+            wait = bucket.wait_time(now)
+            if wait:
+                return self.reject("user_rate", wait)
+            wait = self.global_bucket.wait_time(now)
+            if wait:
+                return self.reject("global_rate", wait)
+            bucket.take()
+            self.global_bucket.take()
+            self.admitted += 1
+            return None
+
+    def reject(self, reason, wait):
+        '''
+        Count a rejection, must be called with the lock held
+        '''
+        self.rejected[reason] += 1
+        return reason, wait
+
+    def forget(self, now):
+        '''
+        Drop the buckets of users that are back to a full burst, must be
+        called with the lock held
+        '''
+        for user_id, bucket in list(self.user_buckets.items()):
+            if bucket.is_full(now):
+                del self.user_buckets[user_id]
+
+    def stats(self):
+        '''
+        Get the admission counters
+        '''
+        with self.lock:
+            return {
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+                "in_flight": self.in_flight(),
+                "max_in_flight": self.max_in_flight,
+                "tracked_users": len(self.user_buckets),
+            }
+
+
+class FairQueue:
+    '''
+    Queue serving its keys (users) round-robin, so that one key with many
+    items cannot hold up the others. Items of a key keep their order.
+    '''
+
+    def __init__(self, maxsize=0):
+        '''
+        Initialize an empty FairQueue holding at most maxsize items, or
+        any number if maxsize is 0
+        '''
+        self.maxsize = maxsize
+        self.condition = threading.Condition()
+        # key -> its items, in the order keys take their turn
+        self.keys = OrderedDict()
+        self.size = 0
+
+    def put_nowait(self, key, item):
+        '''
+        Add an item for a key, raising queue.Full if the queue is full
+        '''
+        with self.condition:
+            if self.maxsize and self.size >= self.maxsize:
+                raise queue.Full()
+            self.keys.setdefault(key, deque()).append(item)
+            self.size += 1
+            self.condition.notify()
+
+    def get(self, block=True):
+        '''
+        Remove and return the next item of the key whose turn it is,
+        raising queue.Empty if there is none and block is not set
+        '''
+        with self.condition:
+            while not self.size:
+                if not block:
+                    raise queue.Empty()
+                self.condition.wait()
+            key, items = self.keys.popitem(last=False)
+            item = items.popleft()
+            if items:
+                self.keys[key] = items
+            self.size -= 1
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        with self.condition:
+            return self.size
+
+    def key_count(self):
+        '''
+        Get the number of keys with items waiting
+        '''
+        with self.condition:
+            return len(self.keys)
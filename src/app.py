@@ -1,42 +1,153 @@
 import json
+import math
+import os
 from db import db
-from flask import Flask, request
+from flask import Flask, Response, redirect, request, send_file
+from sqlalchemy.exc import IntegrityError
 from db import User, Genre, Query, Song
-from openai import OpenAI
-import gpt4_querier
-import pinata_integration
+import admission
+import blob_store
+import bulk
+import config
+import encoders
+import generation_cache
+import jobs
+import json_response
+import migrations
+import mood_index
+import moods
+import pagination
+import pregeneration
+import renderer
+import response_cache
+import streams
+import telemetry
 
 app = Flask(__name__)
-db_filename = "nocturne.db"
-
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
+app.config.from_mapping(config.database_config())
 
 db.init_app(app)
 with app.app_context():
-    db.create_all()
+    migrations.upgrade(db)
+    song_index = mood_index.load(mood_index.MoodIndex())
+
+generations = generation_cache.GenerationCache(
+    max_keys=int(os.environ.get("NOCTURNE_CACHE_SIZE", 1024)),
+    ttl=float(os.environ.get("NOCTURNE_CACHE_TTL", 24 * 60 * 60)),
+    variants=int(os.environ.get("NOCTURNE_CACHE_VARIANTS", 1))
+)
+renderers = renderer.RendererPool(
+    workers=int(os.environ.get("NOCTURNE_RENDER_WORKERS", 2))
+)
+blobs = blob_store.BlobStore(
+    os.environ.get("NOCTURNE_BLOB_DIR", os.path.join(app.instance_path, "blobs")),
+    max_bytes=int(os.environ.get("NOCTURNE_BLOB_MAX_BYTES", 2 * 1024 ** 3))
+)
+note_streams = streams.NoteStreams()
+pinner = jobs.Pinner(
+    app,
+    blobs,
+    batch_size=int(os.environ.get("NOCTURNE_PIN_BATCH_SIZE", 16)),
+    interval=float(os.environ.get("NOCTURNE_PIN_INTERVAL", 2.0)),
+    cache=generations
+)
+if config.env_flag("NOCTURNE_ASYNC_JOBS"):
+    # Generations wait on the LLM as coroutines, hundreds fit in a process
+    job_queue = jobs.AsyncJobQueue(
+        app,
+        renderers,
+        blobs,
+        pinner,
+        workers=int(os.environ.get("NOCTURNE_JOB_IN_FLIGHT", 200)),
+        max_pending=int(os.environ.get("NOCTURNE_JOB_QUEUE_SIZE", 1000)),
+        cache=generations,
+        streams=note_streams
+    )
+else:
+    job_queue = jobs.JobQueue(
+        app,
+        renderers,
+        blobs,
+        pinner,
+        workers=int(os.environ.get("NOCTURNE_JOB_WORKERS", 4)),
+        max_pending=int(os.environ.get("NOCTURNE_JOB_QUEUE_SIZE", 100)),
+        cache=generations,
+        streams=note_streams
+    )
+admissions = admission.Admission(
+    user_rate=float(os.environ.get("NOCTURNE_USER_GENERATION_RATE", 0.2)),
+    user_burst=int(os.environ.get("NOCTURNE_USER_GENERATION_BURST", 5)),
+    global_rate=float(os.environ.get("NOCTURNE_GENERATION_RATE", 5)),
+    global_burst=int(os.environ.get("NOCTURNE_GENERATION_BURST", 50)),
+    max_in_flight=int(os.environ.get(
+        "NOCTURNE_MAX_IN_FLIGHT", job_queue.workers + job_queue.pending.maxsize)),
+    in_flight=job_queue.in_flight,
+    retry_after=float(os.environ.get("NOCTURNE_RETRY_AFTER", 5))
+)
+pregenerator = pregeneration.Pregenerator(
+    app,
+    job_queue,
+    pairs=int(os.environ.get("NOCTURNE_PREGEN_PAIRS", 50)),
+    variants=int(os.environ.get("NOCTURNE_PREGEN_VARIANTS", 4)),
+    output_format=os.environ.get("NOCTURNE_PREGEN_FORMAT", encoders.DEFAULT_FORMAT)
+)
+pinner.start()
+job_queue.start()
+# Refilled by the server itself, another process would have its own view
+# of the blob store and could evict audio this one still holds
+pregen_interval = float(os.environ.get("NOCTURNE_PREGEN_INTERVAL", 300))
+if pregen_interval > 0:
+    pregenerator.start(pregen_interval)
+responses = response_cache.ResponseCache(
+    max_bytes=int(os.environ.get("NOCTURNE_RESPONSE_CACHE_BYTES", 64 * 1024 * 1024)),
+    # Bounds how stale a payload can get after a write from another process
+    ttl=float(os.environ.get("NOCTURNE_RESPONSE_CACHE_TTL", 2))
+)
+responses.watch()
+telemetry.instrument(app)
+telemetry.Gauge("nocturne_job_queue_depth", "Queries waiting to be generated",
+                job_queue.depth)
+telemetry.Gauge("nocturne_job_queue_users", "Users with queries waiting",
+                job_queue.pending.key_count)
+telemetry.Gauge("nocturne_jobs_in_flight", "Queries queued or being generated",
+                job_queue.in_flight)
+telemetry.Gauge("nocturne_render_queue_depth", "Renders waiting for a synth process",
+                lambda: renderers.stats()["queue_depth"])
+telemetry.Gauge("nocturne_blob_store_bytes", "Size of the local blob store",
+                lambda: blobs.stats()["bytes"])
+# Let a reverse proxy send audio files with X-Sendfile when there is one
+app.config["USE_X_SENDFILE"] = config.env_flag("NOCTURNE_X_SENDFILE")
 
 # generalized response formats
 
 
-def success_response(data, code=200):
-    return json.dumps(data), code
+success_response = json_response.success_response
+failure_response = json_response.failure_response
+app.after_request(json_response.compress)
+
+
+def too_many_requests(message, retry_after):
+    response = failure_response(message, 429)
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
 
 
-def failure_response(message, code=404):
-    return json.dumps({"error": message}), code
+@app.errorhandler(pagination.PaginationError)
+@app.errorhandler(bulk.BulkError)
+def bad_request(error):
+    return failure_response(str(error), 400)
 
 # ---------- User Routes ---------- #
 
 
 @app.route('/api/users/', methods=['GET'])
+@responses.cached("users")
 def get_users():
     """
-    Endpoint for getting all users
+    Endpoint for getting a page of users
     """
-    users = [user.serialize() for user in User.query.all()]
-    return success_response({"users": users})
+    users = pagination.filter_genre(User.query, User, request.args)
+    return success_response(pagination.paginate(users, User, request.args, "users"))
 
 
 @app.route('/api/users/', methods=['POST'])
@@ -45,17 +156,38 @@ def create_user():
     Endpoint for creating a user
     """
     body = json.loads(request.data)
+    if User.query.filter_by(email=body.get('email')).first() is not None:
+        return failure_response("Email already in use", 409)
     new_user = User(
         username=body.get('username'),
         email=body.get('email'),
         hashed_password=body.get('hashed_password')
     )
     db.session.add(new_user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Taken by a concurrent request since the check, or a field missing
+        db.session.rollback()
+        if User.query.filter_by(email=body.get('email')).first() is not None:
+            return failure_response("Email already in use", 409)
+        return failure_response("Missing username, email or hashed_password", 400)
     return success_response(new_user.serialize(), 201)
 
 
+@app.route('/api/users/bulk/', methods=['POST'])
+def create_users():
+    """
+    Endpoint for creating many users from a JSON array or NDJSON stream
+    """
+    report = bulk.create_all(bulk.read_items(request), bulk.create_users)
+    # Bulk inserts bypass the session events the cache listens to
+    responses.invalidate("users")
+    return success_response(report)
+
+
 @app.route('/api/users/<int:user_id>/', methods=['GET'])
+@responses.cached("user:{user_id}")
 def get_user(user_id):
     """
     Endpoint for getting a user
@@ -74,20 +206,31 @@ def delete_user(user_id):
     user = User.query.filter_by(id=user_id).first()
     if user is None:
         return failure_response("User not found")
+    # Serialize first, the user's songs and queries are deleted with it
+    serialized = user.serialize()
+    song_ids = [song.id for song in user.songs]
     db.session.delete(user)
     db.session.commit()
-    return success_response(user.serialize())
+    for song_id in song_ids:
+        song_index.remove(song_id)
+    return success_response(serialized)
 
 # ---------- Song Routes ---------- #
 
 
 @app.route('/api/songs/', methods=['GET'])
+@responses.cached("songs")
 def get_songs():
     """
-    Endpoint for getting all songs
+    Endpoint for getting a page of songs
     """
-    songs = [song.serialize() for song in Song.query.all()]
-    return success_response({"songs": songs})
+    songs = pagination.filter_genre(Song.query, Song, request.args)
+    user_id = pagination.int_arg(request.args, 'user_id')
+    if user_id is not None:
+        songs = songs.filter(Song.user_id == user_id)
+    if request.args.get('mood') is not None:
+        songs = songs.filter(Song.mood == request.args['mood'])
+    return success_response(pagination.paginate(songs, Song, request.args, "songs"))
 
 
 @app.route('/api/songs/', methods=['POST'])
@@ -96,20 +239,65 @@ def create_song():
     Endpoint for creating a song
     """
     body = json.loads(request.data)
+    if User.query.filter_by(id=body.get('user_id')).first() is None:
+        return failure_response("User not found")
     new_song = Song(
         title=body.get('title'),
         likes=body.get('likes', 0),
         user_id=body.get('user_id'),
         mood=body.get('mood', ''),
-        genres=[Genre.query.get(genre_id)
-                for genre_id in body.get('genre_ids', [])],
+        genres=Genre.query.filter(Genre.id.in_(body.get('genre_ids', []))).all(),
     )
     db.session.add(new_song)
     db.session.commit()
+    song_index.add(new_song.id, new_song.mood,
+                   [genre.id for genre in new_song.genres])
     return success_response(new_song.serialize(), 201)
 
 
+@app.route('/api/songs/bulk/', methods=['POST'])
+def create_songs():
+    """
+    Endpoint for creating many songs from a JSON array or NDJSON stream
+    """
+    report = bulk.create_all(bulk.read_items(request), bulk.create_songs)
+    responses.invalidate("songs", "users", *{
+        "user:%s" % result["user_id"] for result in report["results"] if "id" in result})
+    for result in report["results"]:
+        if "id" in result:
+            song_index.add(result["id"], result["mood"], result["genre_ids"])
+    return success_response(report)
+
+
+@app.route('/api/songs/recommendations/', methods=['GET'])
+def get_song_recommendations():
+    """
+    Endpoint for getting the songs nearest in mood to a mood or a song
+    """
+    k = pagination.int_arg(request.args, 'k', 10)
+    if not 1 <= k <= 100:
+        return failure_response("k must be between 1 and 100", 400)
+    song_id = pagination.int_arg(request.args, 'song_id')
+    if song_id is not None:
+        vector = song_index.vector(song_id)
+        if vector is None:
+            return failure_response("Song not found or has no known mood")
+    else:
+        vector = moods.mood_vector(request.args.get('mood'))
+        if vector is None:
+            return failure_response("Unknown mood", 400)
+    song_ids = song_index.nearest(
+        vector[0], vector[1], k,
+        genre_id=pagination.int_arg(request.args, 'genre_id'),
+        exclude=song_id)
+    songs = {song.id: song for song in Song.query.filter(Song.id.in_(song_ids))}
+    return success_response({"songs": [
+        songs[song_id].serialize() for song_id in song_ids if song_id in songs
+    ]})
+
+
 @app.route('/api/songs/<int:song_id>/', methods=['GET'])
+@responses.cached("song:{song_id}")
 def get_song(song_id):
     """
     Endpoint for getting a song
@@ -130,18 +318,19 @@ def delete_song(song_id):
         return failure_response("Song not found")
     db.session.delete(song)
     db.session.commit()
+    song_index.remove(song_id)
     return success_response(song.serialize())
 
 # ---------- Genre Routes ---------- #
 
 
 @app.route('/api/genres/', methods=['GET'])
+@responses.cached("genres")
 def get_genres():
     """
-    Endpoint for getting all genres
+    Endpoint for getting a page of genres
     """
-    genres = [genre.serialize() for genre in Genre.query.all()]
-    return success_response({"genres": genres})
+    return success_response(pagination.paginate(Genre.query, Genre, request.args, "genres"))
 
 
 @app.route('/api/genres/', methods=['POST'])
@@ -158,7 +347,34 @@ def create_genre():
     return success_response(new_genre.serialize(), 201)
 
 
+@app.route('/api/genres/bulk/', methods=['POST'])
+def create_genres():
+    """
+    Endpoint for creating many genres from a JSON array or NDJSON stream
+    """
+    report = bulk.create_all(bulk.read_items(request), bulk.create_genres)
+    responses.invalidate("genres")
+    return success_response(report)
+
+
+@app.route('/api/genres/links/bulk/', methods=['POST'])
+def create_genre_links():
+    """
+    Endpoint for linking many users, songs or queries to genres
+    """
+    report = bulk.create_all(bulk.read_items(request), bulk.create_links)
+    responses.invalidate_all()
+    # Songs that gained a genre are re-indexed with their new genres
+    song_ids = list({result["id"][0] for result in report["results"]
+                     if result.get("kind") == "song_id"})
+    for start in range(0, len(song_ids), 1000):
+        for song in Song.query.filter(Song.id.in_(song_ids[start:start + 1000])):
+            song_index.add(song.id, song.mood, [genre.id for genre in song.genres])
+    return success_response(report)
+
+
 @app.route('/api/genres/<int:genre_id>/', methods=['GET'])
+@responses.cached("genre:{genre_id}")
 def get_genre(genre_id):
     """
     Endpoint for getting a genre
@@ -179,18 +395,27 @@ def delete_genre(genre_id):
         return failure_response("Genre not found")
     db.session.delete(genre)
     db.session.commit()
+    song_index.remove_genre(genre_id)
     return success_response(genre.serialize())
 
 # ---------- Query Routes ---------- #
 
 
 @app.route('/api/queries/', methods=['GET'])
+@responses.cached("queries")
 def get_queries():
     """
-    Endpoint for getting all queries
+    Endpoint for getting a page of queries
     """
-    queries = [query.serialize() for query in Query.query.all()]
-    return success_response({"queries": queries})
+    queries = pagination.filter_genre(Query.query, Query, request.args)
+    user_id = pagination.int_arg(request.args, 'user_id')
+    if user_id is not None:
+        queries = queries.filter(Query.user_id == user_id)
+    if request.args.get('mood') is not None:
+        queries = queries.filter(Query.mood == request.args['mood'])
+    if request.args.get('status') is not None:
+        queries = queries.filter(Query.status == request.args['status'])
+    return success_response(pagination.paginate(queries, Query, request.args, "queries"))
 
 
 @app.route('/api/queries/', methods=['POST'])
@@ -199,23 +424,119 @@ def create_query():
     Endpoint for creating a query
     """
     body = json.loads(request.data)
-    generated_midi = gpt4_querier.generate_midi(body.get(
-        'mood', ''), [genre for genre in body.get('genres', [])], body.get('query'), 10)
-    file_path = gpt4_querier.create_midi(generated_midi[0], generated_midi[1])
-    pinata_path = pinata_integration.upload_pinata(file_path)
+    output_format = body.get('format', encoders.DEFAULT_FORMAT)
+    if output_format not in encoders.FORMATS:
+        return failure_response("Unsupported format, expected one of: " +
+                                ", ".join(encoders.FORMATS), 400)
+    duration = body.get('duration', 10)
+    # Seconds, the note parser drops anything past 10 minutes anyway
+    if not bulk.is_a(duration, int) or not 1 <= duration <= 600:
+        return failure_response("duration must be an integer between 1 and 600", 400)
+    if User.query.filter_by(id=body.get('user_id')).first() is None:
+        return failure_response("User not found")
+    genre_names = body.get('genres', [])
     new_query = Query(
         query=body.get('query'),
         user_id=body.get('user_id'),
         mood=body.get('mood', ''),
-        genres=[genre for genre in body.get('genres', [])],
-        pinata_url="ipfs.io/ipfs/" + pinata_path
+        duration=duration,
+        output_format=output_format,
+        genres=Genre.query.filter(Genre.genre.in_(genre_names)).all()
+        if genre_names else [],
     )
+    cached = generations.get(generation_cache.make_key(
+        new_query.mood, [genre.genre for genre in new_query.genres],
+        new_query.text, new_query.duration, new_query.output_format))
+    if (cached is None and pregeneration.is_generic(new_query.text)
+            and len(new_query.genres) <= 1):
+        variant = pregenerator.claim(
+            new_query.mood, new_query.genres[0].id if new_query.genres else None,
+            new_query.output_format, new_query.duration)
+        if variant is not None:
+            cached = {"title": variant.title, "file_hash": variant.blob_hash,
+                      "cid": None}
+    if cached is not None:
+        new_query.title = cached["title"]
+        new_query.blob_hash = cached["file_hash"]
+        new_query.status = jobs.DONE
+        if cached["cid"] is not None:
+            new_query.pinata_url = "ipfs.io/ipfs/" + cached["cid"]
+        db.session.add(new_query)
+        db.session.commit()
+        if cached["cid"] is None:
+            pinner.submit(new_query.id)
+        return success_response(new_query.serialize(), 201)
+    # Cache hits cost nothing, anything else has to be admitted
+    rejection = admissions.admit(new_query.user_id)
+    if rejection is not None:
+        reason, retry_after = rejection
+        telemetry.admission_rejections.inc(reason=reason)
+        return too_many_requests(
+            "Too many generation requests, try again later", retry_after)
     db.session.add(new_query)
     db.session.commit()
-    return success_response(new_query.serialize(), 201)
+    # Opened before the job starts so that no note is missed
+    channel = note_streams.open(new_query.id) if body.get('stream') else None
+    try:
+        job_queue.submit(new_query.id, new_query.user_id)
+    except jobs.QueueFull:
+        new_query.status = jobs.FAILED
+        new_query.error = "Generation queue is full"
+        db.session.commit()
+        if channel is not None:
+            channel.close(jobs.FAILED, {'id': new_query.id, **new_query.serialize_status()})
+        telemetry.admission_rejections.inc(reason="queue_full")
+        return too_many_requests("Generation queue is full, try again later",
+                                 admissions.retry_after)
+    response = new_query.serialize()
+    if channel is not None:
+        response['events_url'] = '/api/queries/%d/events/' % new_query.id
+    return success_response(response, 202)
+
+
+@app.route('/api/queries/cache/', methods=['GET'])
+def get_generation_cache():
+    """
+    Endpoint for getting the generation cache hit/miss counters
+    """
+    return success_response(generations.stats())
+
+
+@app.route('/api/responses/cache/', methods=['GET'])
+def get_response_cache():
+    """
+    Endpoint for getting the hit ratio and memory use of the response cache
+    """
+    return success_response(responses.stats())
+
+
+@app.route('/api/queries/admission/', methods=['GET'])
+def get_admission():
+    """
+    Endpoint for getting the admitted and rejected generation counters
+    """
+    return success_response({**admissions.stats(), "queue_depth": job_queue.depth(),
+                             "queued_users": job_queue.pending.key_count()})
+
+
+@app.route('/api/queries/pregenerated/', methods=['GET'])
+def get_pregenerated():
+    """
+    Endpoint for getting the size of the pre-generated song pool
+    """
+    return success_response(pregenerator.stats())
+
+
+@app.route('/api/queries/renderers/', methods=['GET'])
+def get_renderers():
+    """
+    Endpoint for getting the queue depth of the renderer pool
+    """
+    return success_response(renderers.stats())
 
 
 @app.route('/api/queries/<int:query_id>/', methods=['GET'])
+@responses.cached("query:{query_id}")
 def get_query(query_id):
     """
     Endpoint for getting a query
@@ -226,6 +547,82 @@ def get_query(query_id):
     return success_response(query.serialize())
 
 
+@app.route('/api/queries/<int:query_id>/audio/', methods=['GET'])
+def get_query_audio(query_id):
+    """
+    Endpoint for streaming the rendered audio of a query, with support for
+    range requests
+    """
+    query = Query.query.filter_by(id=query_id).first()
+    if query is None or query.blob_hash is None:
+        return failure_response("Audio not found")
+    path = blobs.open(query.blob_hash)
+    if path is None:
+        # Only pinned audio is evicted, so it is still on IPFS
+        if not query.pinata_url:
+            return failure_response("Audio not found")
+        return redirect("https://" + query.pinata_url)
+    return send_file(
+        path,
+        mimetype=encoders.content_type(query.output_format),
+        download_name=encoders.file_name(query.title or "song", query.output_format),
+        conditional=True,
+        etag=query.blob_hash,
+        max_age=365 * 24 * 60 * 60,
+    )
+
+
+@app.route('/api/queries/blobs/', methods=['GET'])
+def get_blob_store():
+    """
+    Endpoint for getting the size of the local audio blob store
+    """
+    return success_response(blobs.stats())
+
+
+@app.route('/api/queries/<int:query_id>/events/', methods=['GET'])
+def get_query_events(query_id):
+    """
+    Endpoint for following a streamed query as server-sent events: "notes"
+    as the melody is written, "status" once it is rendering, then "done"
+    or "failed". Queries that are not streamed by this process only get
+    their current status. Under asgi.py streamed queries are served by
+    asgi.stream_events instead, without holding a WSGI thread.
+    """
+    query = Query.query.filter_by(id=query_id).first()
+    if query is None:
+        return failure_response("Query not found")
+    channel = note_streams.get(query_id)
+    if channel is None:
+        events = [(query.status, {'id': query.id, 'title': query.title,
+                                  'audio_url': query.audio_url(),
+                                  **query.serialize_status()})]
+    else:
+        events = channel.listen()
+
+    return Response(map(streams.encode, events), mimetype="text/event-stream",
+                    headers=streams.HEADERS)
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Endpoint for scraping metrics in the Prometheus text format
+    """
+    return Response(telemetry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/api/queries/<int:query_id>/status/', methods=['GET'])
+def get_query_status(query_id):
+    """
+    Endpoint for polling the generation progress of a query
+    """
+    query = Query.query.filter_by(id=query_id).first()
+    if query is None:
+        return failure_response("Query not found")
+    return success_response({'id': query.id, **query.serialize_status()})
+
+
 @app.route('/api/queries/<int:query_id>/', methods=['DELETE'])
 def delete_query(query_id):
     """
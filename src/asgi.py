@@ -0,0 +1,68 @@
+import asyncio
+import os
+import re
+from a2wsgi import WSGIMiddleware
+
+# ASGI application for uvicorn and other ASGI servers. The Flask views run
+# on a pool of threads next to the server's event loop, and generations
+# run as coroutines on the async job queue unless NOCTURNE_ASYNC_JOBS=0.
+# Server-sent events of streamed queries are served on the event loop
+# itself, a listener waits for the whole generation and would otherwise
+# hold one of the threads all along.
+#   uvicorn asgi:application --port 8000
+# serve.py wraps this with the settings below. Run a single worker, see
+# serve.py for why.
+
+os.environ.setdefault("NOCTURNE_ASYNC_JOBS", "1")
+
+from app import app, note_streams  # noqa: E402
+import streams  # noqa: E402
+
+EVENTS_PATH = re.compile(r"^/api/queries/(\d+)/events/$")
+
+wsgi = WSGIMiddleware(
+    app, workers=int(os.environ.get("NOCTURNE_WSGI_THREADS", 16)))
+
+
+async def stream_events(channel, receive, send):
+    '''
+    Relay the events of a channel until it closes or the client leaves
+    '''
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"text/event-stream; charset=utf-8")] + [
+            (name.lower().encode(), value.encode())
+            for name, value in streams.HEADERS.items()],
+    })
+
+    async def relay():
+        async for event in channel.alisten():
+            await send({"type": "http.response.body",
+                        "body": streams.encode(event), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def disconnected():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    tasks = [asyncio.ensure_future(relay()), asyncio.ensure_future(disconnected())]
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    for task in done:
+        task.result()
+
+
+async def application(scope, receive, send):
+    '''
+    Serve the events of queries streamed by this process, and everything
+    else through Flask
+    '''
+    if scope["type"] == "http" and scope["method"] == "GET":
+        match = EVENTS_PATH.match(scope["path"])
+        channel = note_streams.get(int(match.group(1))) if match else None
+        if channel is not None:
+            await stream_events(channel, receive, send)
+            return
+    await wsgi(scope, receive, send)
@@ -0,0 +1,138 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+
+class BlobStore:
+    '''
+    Local content-addressed store of rendered audio. Blobs live at
+    root/ab/cd/abcd... by sha256, and once the store is over max_bytes the
+    least recently used blobs are deleted, except held ones (not pinned to
+    IPFS yet).
+    '''
+
+    def __init__(self, root, max_bytes=2 * 1024 ** 3):
+        '''
+        Initialize a BlobStore in root, indexing the blobs already there
+        '''
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.held = set()
+        # blob hash -> [size, last access]
+        self.blobs = {}
+        self.size = 0
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+        for directory, subdirectories, files in os.walk(root):
+            if os.path.basename(directory) == "tmp":
+                for name in files:
+                    os.remove(os.path.join(directory, name))
+                continue
+            for name in files:
+                stat = os.stat(os.path.join(directory, name))
+                self.blobs[name] = [stat.st_size, stat.st_mtime]
+                self.size += stat.st_size
+
+    def path(self, blob_hash):
+        '''
+        Get the path a blob is stored at
+        '''
+        return os.path.join(self.root, blob_hash[:2], blob_hash[2:4], blob_hash)
+
+    def put(self, chunks, hold=False):
+        '''
+        Store the bytes of chunks and return their sha256 hex digest,
+        holding the blob against eviction if hold is set
+        '''
+        digest = hashlib.sha256()
+        size = 0
+        handle, temp_path = tempfile.mkstemp(dir=os.path.join(self.root, "tmp"))
+        try:
+            with os.fdopen(handle, "wb") as file:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    file.write(chunk)
+            blob_hash = digest.hexdigest()
+            path = self.path(blob_hash)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        with self.lock:
+            if hold:
+                self.held.add(blob_hash)
+            if blob_hash not in self.blobs:
+                self.blobs[blob_hash] = [size, time.time()]
+                self.size += size
+            self.evict()
+        return blob_hash
+
+    def open(self, blob_hash):
+        '''
+        Get the path of a blob for reading and mark it as recently used,
+        or None if it is not in the store
+        '''
+        with self.lock:
+            entry = self.blobs.get(blob_hash)
+            if entry is None:
+                return None
+            entry[1] = time.time()
+        return self.path(blob_hash)
+
+    def read(self, blob_hash, chunk_size=1 << 16):
+        '''
+        Iterate over the bytes of a blob in chunks
+        '''
+        with open(self.path(blob_hash), "rb") as file:
+            for chunk in iter(lambda: file.read(chunk_size), b""):
+                yield chunk
+
+    def hold(self, blob_hash):
+        '''
+        Protect a blob from eviction
+        '''
+        with self.lock:
+            self.held.add(blob_hash)
+
+    def release(self, blob_hash):
+        '''
+        Allow a blob to be evicted again
+        '''
+        with self.lock:
+            self.held.discard(blob_hash)
+            self.evict()
+
+    def evict(self):
+        '''
+        Delete least recently used blobs until the store fits max_bytes,
+        must be called with the lock held
+        '''
+        if self.size <= self.max_bytes:
+            return
+        candidates = sorted(
+            (entry[1], blob_hash) for blob_hash, entry in self.blobs.items()
+            if blob_hash not in self.held)
+        for last_access, blob_hash in candidates:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(self.path(blob_hash))
+            except FileNotFoundError:
+                pass
+            self.size -= self.blobs.pop(blob_hash)[0]
+
+    def stats(self):
+        '''
+        Get the size and occupancy of the store
+        '''
+        with self.lock:
+            return {
+                "blobs": len(self.blobs),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "held": len(self.held),
+            }
@@ -0,0 +1,344 @@
+import json
+import time
+from itertools import islice
+from sqlalchemy import func, or_, text
+from db import db
+from db import User, Genre, Query, Song
+from db import association_table2, association_table5, association_table8
+
+# Items are resolved and inserted in batches of this size, all batches of
+# a request share one transaction
+batch_size = 5000
+
+NDJSON_TYPES = ("application/x-ndjson", "application/jsonl", "application/json-seq")
+
+# Expected JSON type of every item field, a list holds the type of the
+# elements of a list field
+FIELD_TYPES = {
+    'username': str, 'email': str, 'hashed_password': str, 'genre': str,
+    'title': str, 'mood': str, 'likes': int, 'user_id': int, 'song_id': int,
+    'query_id': int, 'genre_id': int, 'genre_ids': [int], 'genres': [str],
+}
+TYPE_NAMES = {int: "an integer", str: "a string"}
+LIST_NAMES = {int: "a list of integers", str: "a list of strings"}
+
+
+class BulkError(Exception):
+    '''
+    Raised when a bulk request body cannot be read at all
+    '''
+
+
+def read_items(request):
+    '''
+    Iterate over the items of a bulk request, either a JSON array or an
+    NDJSON stream read line by line
+    '''
+    if request.mimetype in NDJSON_TYPES:
+        return read_ndjson(request.stream)
+    try:
+        items = json.loads(request.data)
+    except ValueError:
+        raise BulkError("Body must be a JSON array or NDJSON")
+    if not isinstance(items, list):
+        raise BulkError("Body must be a JSON array or NDJSON")
+    return iter(items)
+
+
+def read_ndjson(stream):
+    '''
+    Iterate over the JSON documents of an NDJSON stream, lines that are
+    not valid JSON come out as None and are reported as item errors
+    '''
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+def create_all(items, create_batch):
+    '''
+    Run create_batch over items in batches inside a single transaction and
+    report the outcome of every item
+    '''
+    start = time.perf_counter()
+    if db.session.get_bind().dialect.name == "sqlite":
+        # Take the write lock before allocate_ids reads the largest id,
+        # under WAL a writer committing in between would make this
+        # transaction fail with SQLITE_BUSY_SNAPSHOT
+        db.session.execute(text("BEGIN IMMEDIATE"))
+    results = []
+    items = iter(items)
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch:
+            break
+        offset = len(results)
+        valid = []
+        for i, item in enumerate(batch):
+            if isinstance(item, dict):
+                results.append(None)
+                valid.append((offset + i, item))
+            else:
+                results.append({"index": offset + i,
+                                "error": "Item must be a JSON object"})
+        for index, result in create_batch(valid):
+            results[index] = {"index": index, **result}
+    db.session.commit()
+    elapsed = time.perf_counter() - start
+    created = sum(1 for result in results if "id" in result)
+    return {
+        "created": created,
+        "failed": len(results) - created,
+        "seconds": elapsed,
+        "rows_per_second": created / elapsed if elapsed else 0.0,
+        "results": results,
+    }
+
+
+def missing_fields(item, fields):
+    '''
+    Get an error for the first required field missing from an item
+    '''
+    for field in fields:
+        if item.get(field) in (None, ''):
+            return {"error": "Missing %s" % field}
+    return None
+
+
+def is_a(value, kind):
+    # JSON booleans are ints to Python
+    return isinstance(value, kind) and not (kind is int and isinstance(value, bool))
+
+
+def invalid_fields(item, fields):
+    '''
+    Get an error for the first field of an item that has the wrong type
+    '''
+    for field in fields:
+        value = item.get(field)
+        if value is None:
+            continue
+        kind = FIELD_TYPES[field]
+        if isinstance(kind, list):
+            if not isinstance(value, list) or not all(
+                    is_a(element, kind[0]) for element in value):
+                return {"error": "%s must be %s" % (field, LIST_NAMES[kind[0]])}
+        elif not is_a(value, kind):
+            return {"error": "%s must be %s" % (field, TYPE_NAMES[kind])}
+    return None
+
+
+def check_items(items, required, optional=()):
+    '''
+    Split (index, item) pairs into errors for items missing a required
+    field or with a field of the wrong type, and the valid items
+    '''
+    errors = []
+    valid = []
+    for index, item in items:
+        error = missing_fields(item, required) or invalid_fields(
+            item, required + optional)
+        if error is None:
+            valid.append((index, item))
+        else:
+            errors.append((index, error))
+    return errors, valid
+
+
+def allocate_ids(model, count):
+    '''
+    Reserve count primary keys of a model. Postgres hands them out from
+    the table's sequence, on SQLite create_all holds the write lock so
+    the next ids after the largest one stay free until it commits.
+    '''
+    table = model.__table__
+    if db.session.get_bind().dialect.name == "postgresql":
+        return [id for (id,) in db.session.execute(text(
+            "SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+            "FROM generate_series(1, :count)"),
+            {"table": table.name, "count": count})]
+    start = db.session.query(func.max(model.id)).scalar() or 0
+    return range(start + 1, start + count + 1)
+
+
+def insert(model, index_rows):
+    '''
+    Insert (index, row) pairs of a model with one executemany and report
+    their ids
+    '''
+    if not index_rows:
+        return []
+    rows = [row for index, row in index_rows]
+    for row, id in zip(rows, allocate_ids(model, len(rows))):
+        row["id"] = id
+    db.session.execute(model.__table__.insert(), rows)
+    return [(index, {"id": row["id"]}) for index, row in index_rows]
+
+
+def create_users(items):
+    '''
+    Create a batch of users, rejecting emails that are already taken
+    '''
+    results, items = check_items(items, ('username', 'email', 'hashed_password'))
+    rows = []
+    emails = {item['email'] for index, item in items}
+    taken = {email for (email,) in db.session.query(User.email).filter(
+        User.email.in_(emails))}
+    for index, item in items:
+        if item['email'] in taken:
+            results.append((index, {"error": "Email already in use"}))
+            continue
+        taken.add(item['email'])
+        rows.append((index, {
+            'username': item['username'],
+            'email': item['email'],
+            'hashed_password': item['hashed_password'],
+        }))
+    return results + insert(User, rows)
+
+
+def create_genres(items):
+    '''
+    Create a batch of genres
+    '''
+    results, items = check_items(items, ('genre',))
+    rows = [(index, {'genre': item['genre']}) for index, item in items]
+    return results + insert(Genre, rows)
+
+
+def resolve_genres(items):
+    '''
+    Look up every genre referenced by id (genre_ids) or name (genres) in
+    a batch with one query, returning id -> id and name -> id maps
+    '''
+    ids = set()
+    names = set()
+    for index, item in items:
+        ids.update(item.get('genre_ids') or [])
+        names.update(item.get('genres') or [])
+    by_id = {}
+    by_name = {}
+    if ids or names:
+        for genre_id, name in db.session.query(Genre.id, Genre.genre).filter(
+                or_(Genre.id.in_(ids), Genre.genre.in_(names))):
+            by_id[genre_id] = genre_id
+            by_name[name] = genre_id
+    return by_id, by_name
+
+
+def genre_ids_of(item, by_id, by_name):
+    '''
+    Get the genre ids of an item, or an error naming an unknown genre
+    '''
+    genre_ids = []
+    for genre_id in item.get('genre_ids') or []:
+        if genre_id not in by_id:
+            return None, {"error": "Genre %s not found" % genre_id}
+        genre_ids.append(genre_id)
+    for name in item.get('genres') or []:
+        if name not in by_name:
+            return None, {"error": "Genre %s not found" % name}
+        genre_ids.append(by_name[name])
+    return list(dict.fromkeys(genre_ids)), None
+
+
+def create_songs(items):
+    '''
+    Create a batch of songs and their genre links, the results of created
+    songs also carry their user id, mood and genre ids
+    '''
+    results, items = check_items(
+        items, ('title', 'user_id'), ('likes', 'mood', 'genre_ids', 'genres'))
+    rows = []
+    genre_ids = {}
+    user_ids = {item['user_id'] for index, item in items}
+    users = {user_id for (user_id,) in db.session.query(User.id).filter(
+        User.id.in_(user_ids))}
+    by_id, by_name = resolve_genres(items)
+    for index, item in items:
+        error = None
+        if item['user_id'] not in users:
+            error = {"error": "User %s not found" % item['user_id']}
+        if error is None:
+            genre_ids[index], error = genre_ids_of(item, by_id, by_name)
+        if error is not None:
+            results.append((index, error))
+            continue
+        rows.append((index, {
+            'title': item['title'],
+            'likes': item.get('likes') or 0,
+            'user_id': item['user_id'],
+            'mood': item.get('mood') or '',
+        }))
+    created = insert(Song, rows)
+    links = [
+        {'song_id': result['id'], 'genre_id': genre_id}
+        for index, result in created for genre_id in genre_ids[index]
+    ]
+    if links:
+        db.session.execute(association_table8.insert(), links)
+    moods = {index: row['mood'] for index, row in rows}
+    owners = {index: row['user_id'] for index, row in rows}
+    return results + [
+        (index, {**result, 'user_id': owners[index], 'mood': moods[index],
+                 'genre_ids': genre_ids[index]})
+        for index, result in created
+    ]
+
+
+# Association table, owner column and owner model for each kind of link
+LINKS = {
+    'user_id': (association_table2, User),
+    'song_id': (association_table8, Song),
+    'query_id': (association_table5, Query),
+}
+
+
+def create_links(items):
+    '''
+    Create a batch of genre links, each item has a genre_id and one of
+    user_id, song_id or query_id. Links that already exist are reported
+    as created without inserting them again.
+    '''
+    results = []
+    by_kind = {}
+    for index, item in items:
+        kinds = [kind for kind in LINKS if item.get(kind) is not None]
+        error = invalid_fields(item, ('genre_id',) + tuple(LINKS))
+        if len(kinds) != 1 or item.get('genre_id') is None:
+            error = {"error": "Expected genre_id and one of " + ", ".join(LINKS)}
+        if error is not None:
+            results.append((index, error))
+        else:
+            by_kind.setdefault(kinds[0], []).append((index, item))
+    genres = {genre_id for (genre_id,) in db.session.query(Genre.id).filter(
+        Genre.id.in_({item['genre_id'] for kind_items in by_kind.values()
+                      for index, item in kind_items}))}
+    for kind, kind_items in by_kind.items():
+        table, model = LINKS[kind]
+        owner_ids = {item[kind] for index, item in kind_items}
+        owners = {owner_id for (owner_id,) in db.session.query(model.id).filter(
+            model.id.in_(owner_ids))}
+        existing = set(db.session.query(table.c[kind], table.c.genre_id).filter(
+            table.c[kind].in_(owner_ids)))
+        rows = []
+        for index, item in kind_items:
+            link = (item[kind], item['genre_id'])
+            if link[0] not in owners:
+                results.append((index, {"error": "%s %s not found" % (
+                    kind, link[0])}))
+            elif link[1] not in genres:
+                results.append((index, {"error": "Genre %s not found" % link[1]}))
+            else:
+                if link not in existing:
+                    existing.add(link)
+                    rows.append({kind: link[0], 'genre_id': link[1]})
+                results.append((index, {"id": list(link), "kind": kind}))
+        if rows:
+            db.session.execute(table.insert(), rows)
+    return results
@@ -1,31 +1,42 @@
 from flask_sqlalchemy import SQLAlchemy
+import moods
 
 db = SQLAlchemy()
 
 ########## Association tables for many to many relationships ##########
 
+# Each association table is keyed on (owner id, genre id), so a link can
+# only exist once and lookups from the owner use the primary key, with a
+# separate index on genre_id for lookups from the genre side
+
 # Many to many relationship association table between User and Genre
 association_table2 = db.Table(
     "user_genre_association",
     db.Model.metadata,
-    db.Column("user_id", db.Integer, db.ForeignKey("users.id")),
-    db.Column("genre_id", db.Integer, db.ForeignKey("genres.id"))
+    db.Column("user_id", db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"),
+              primary_key=True),
+    db.Column("genre_id", db.Integer, db.ForeignKey("genres.id", ondelete="CASCADE"),
+              primary_key=True, index=True)
 )
 
 # Many to many relationship association table between Query and Genre
 association_table5 = db.Table(
     "query_genre_association",
     db.Model.metadata,
-    db.Column("query_id", db.Integer, db.ForeignKey("queries.id")),
-    db.Column("genre_id", db.Integer, db.ForeignKey("genres.id"))
+    db.Column("query_id", db.Integer, db.ForeignKey("queries.id", ondelete="CASCADE"),
+              primary_key=True),
+    db.Column("genre_id", db.Integer, db.ForeignKey("genres.id", ondelete="CASCADE"),
+              primary_key=True, index=True)
 )
 
 # Many to many relationship association table between Song and Genre
 association_table8 = db.Table(
     "song_genre_association",
     db.Model.metadata,
-    db.Column("song_id", db.Integer, db.ForeignKey("songs.id")),
-    db.Column("genre_id", db.Integer, db.ForeignKey("genres.id"))
+    db.Column("song_id", db.Integer, db.ForeignKey("songs.id", ondelete="CASCADE"),
+              primary_key=True),
+    db.Column("genre_id", db.Integer, db.ForeignKey("genres.id", ondelete="CASCADE"),
+              primary_key=True, index=True)
 )
 
 ########## Models ##########
@@ -38,12 +49,19 @@ class User(db.Model):
     __tablename__ = 'users'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     username = db.Column(db.String(80), nullable=False)
-    email = db.Column(db.String(120), nullable=False)
+    email = db.Column(db.String(120), nullable=False, unique=True, index=True)
     hashed_password = db.Column(db.String(120), nullable=False)
-    songs = db.relationship("Song", backref="user")
-    queries = db.relationship("Query", backref="user")
+    # Relationships used by serialize() are loaded with one SELECT ... IN
+    # per relationship for a whole batch of rows, instead of one SELECT
+    # per row, so serializing any number of users takes a fixed number of
+    # queries
+    songs = db.relationship("Song", backref="user", lazy="selectin",
+                            cascade="all, delete-orphan")
+    queries = db.relationship("Query", backref="user", lazy="selectin",
+                              cascade="all, delete-orphan")
     genres = db.relationship(
-        "Genre", secondary=association_table2, back_populates="users")
+        "Genre", secondary=association_table2, back_populates="users",
+        lazy="selectin")
 
     def __init__(self, **kwargs):
         '''
@@ -85,10 +103,12 @@ class Song(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     title = db.Column(db.String(80), nullable=False)
     likes = db.Column(db.Integer, nullable=False, default=0)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'),
+                        nullable=False, index=True)
     mood = db.Column(db.String(80), default='')
     genres = db.relationship(
-        "Genre", secondary=association_table8, back_populates="songs")
+        "Genre", secondary=association_table8, back_populates="songs",
+        lazy="selectin")
 
     def __init__(self, **kwargs):
         '''
@@ -97,6 +117,8 @@ class Song(db.Model):
         self.title = kwargs.get('title')
         self.likes = kwargs.get('likes')
         self.user_id = kwargs.get('user_id')
+        self.mood = kwargs.get('mood', '')
+        self.genres = kwargs.get('genres', [])
 
     def serialize(self):
         '''
@@ -134,29 +156,7 @@ class Song(db.Model):
         '''
         Convert a string to a 2D vector of integers
         '''
-        red = ["enraged", "terrified", "panicked", "shocked", "impassioned", "hyper", "livid", "irate", "overwhelmed", "stressed", "annoyed", "pressured", "furious", "frightened", "anxious", "apprehensive", "irritated",
-               "restless", "jealous", "scared", "angry", "jittery", "fomo", "confused", "envious", "repulsed", "frustrated", "embarrassed", "concerned", "tense", "contempt", "troubled", "worried", "nervous", "peeved", "uneasy"]
-        blue = ["disgusted", "trapped", "insecure", "disheartened", "down", "bored", "humiliated", "ashamed", "lost", "disappointed", "meh", "tired", "pessimistic", "vulnerable", "disconnected", "forlorn", "sad", "fatigued",
-                "guilty", "numb", "excluded", "spent", "discouraged", "disengaged", "depressed", "hopeless", "alienated", "nostalgic", "lonely", "apathetic", "miserable", "despair", "glum", "burned out", "exhausted", "helpless"]
-        yellow = ["surprised", "awe", "exhilarated", "thrilled", "elated", "ecstatic", "excited", "determined", "successful", "amazed", "inspired", "empowered", "energized", "eager", "enthusiastic", "joyful", "productive",
-                  "proud", "cheerful", "curious", "upbeat", "happy", "motivated", "optimistic", "pleasant", "focused", "alive", "confident", "engaged", "challenged", "pleased", "playful", "delighted", "wishful", "hopeful", "accomplished"]
-        green = ["calm", "at ease", "understood", "respected", "fulfilled", "blissful", "good", "thoughtful", "appreciated", "supported", "loved", "connected", "relaxed", "chill", "compassionate", "included", "valued", "grateful",
-                 "sympathetic", "comfortable", "empathetic", "content", "accepted", "moved", "mellow", "peaceful", "balanced", "safe", "secure", "blessed", "carefree", "tranquil", "thankful", "relieved", "satisfied", "serene"]
-        if str in red:
-            x = -red.index(str) % 6
-            y = 6 - (red.index(str) // 6)
-        elif str in blue:
-            x = -blue.index(str) % 6
-            y = -(6 - (blue.index(str) // 6))
-        elif str in yellow:
-            x = yellow.index(str) % 6
-            y = 6 - (yellow.index(str) // 6)
-        elif str in green:
-            x = green.index(str) % 6
-            y = -(6 - (green.index(str) // 6))
-        else:
-            return None
-        return [x, y]
+        return moods.mood_vector(str)
 
 
 class Query(db.Model):
@@ -166,11 +166,23 @@ class Query(db.Model):
     __tablename__ = 'queries'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     text = db.Column(db.String(80), default='')
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'),
+                        nullable=False, index=True)
     mood = db.Column(db.String(80), default='')
     genres = db.relationship(
-        "Genre", secondary=association_table5, back_populates="queries")
+        "Genre", secondary=association_table5, back_populates="queries",
+        lazy="selectin")
     pinata_url = db.Column(db.String, default='')
+    duration = db.Column(db.Integer, nullable=False, default=10)
+    output_format = db.Column(db.String(10), nullable=False, default='wav')
+    title = db.Column(db.String(80), default='')
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    # sha256 of the rendered audio in the local blob store
+    blob_hash = db.Column(db.String(64))
+    error = db.Column(db.String, default='')
+    generating_time = db.Column(db.Float)
+    rendering_time = db.Column(db.Float)
+    uploading_time = db.Column(db.Float)
 
     def __init__(self, **kwargs):
         '''
@@ -178,6 +190,11 @@ class Query(db.Model):
         '''
         self.text = kwargs.get('query')
         self.user_id = kwargs.get('user_id')
+        self.mood = kwargs.get('mood', '')
+        self.genres = kwargs.get('genres', [])
+        self.duration = kwargs.get('duration', 10)
+        self.output_format = kwargs.get('output_format', 'wav')
+        self.status = kwargs.get('status', 'pending')
 
     def serialize(self):
         '''
@@ -190,6 +207,46 @@ class Query(db.Model):
             'mood': self.mood,
             'genres': [genre.serialize() for genre in self.genres],
             'pinata_url': self.pinata_url,
+            'audio_url': self.audio_url(),
+            'duration': self.duration,
+            'format': self.output_format,
+            'title': self.title,
+            **self.serialize_status(),
+        }
+
+    def simple_serialize(self):
+        '''
+        Serialize the Query object without genres
+        '''
+        return {
+            'id': self.id,
+            'query': self.text,
+            'user_id': self.user_id,
+            'mood': self.mood,
+            'pinata_url': self.pinata_url,
+            'status': self.status,
+        }
+
+    def audio_url(self):
+        '''
+        Get the path the rendered audio of the Query object is served at
+        '''
+        if self.blob_hash is None:
+            return None
+        return '/api/queries/%d/audio/' % self.id
+
+    def serialize_status(self):
+        '''
+        Serialize the generation progress of the Query object
+        '''
+        return {
+            'status': self.status,
+            'error': self.error,
+            'timings': {
+                'generating': self.generating_time,
+                'rendering': self.rendering_time,
+                'uploading': self.uploading_time,
+            },
         }
 
 ########## Feature models ##########
@@ -223,3 +280,35 @@ class Genre(db.Model):
             'id': self.id,
             'genre': self.genre,
         }
+
+
+class Pregenerated(db.Model):
+    '''
+    Pregenerated model, a song made ahead of time for a popular (mood,
+    genre) pair and handed out once to a query with a generic prompt
+    '''
+    __tablename__ = 'pregenerated'
+    __table_args__ = (
+        db.Index('ix_pregenerated_lookup',
+                 'mood', 'genre_id', 'output_format', 'duration', 'used'),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    mood = db.Column(db.String(80), nullable=False)
+    genre_id = db.Column(db.Integer, db.ForeignKey('genres.id', ondelete='CASCADE'))
+    duration = db.Column(db.Integer, nullable=False)
+    output_format = db.Column(db.String(10), nullable=False)
+    title = db.Column(db.String(80), default='')
+    blob_hash = db.Column(db.String(64), nullable=False)
+    used = db.Column(db.Boolean, nullable=False, default=False)
+
+    def __init__(self, **kwargs):
+        '''
+        Initialize a Pregenerated object
+        '''
+        self.mood = kwargs.get('mood')
+        self.genre_id = kwargs.get('genre_id')
+        self.duration = kwargs.get('duration', 10)
+        self.output_format = kwargs.get('output_format', 'wav')
+        self.title = kwargs.get('title', '')
+        self.blob_hash = kwargs.get('blob_hash')
+        self.used = False
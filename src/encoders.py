@@ -0,0 +1,110 @@
+import os
+import subprocess
+import threading
+
+chunk_size = 1 << 16
+ffmpeg = os.environ.get("NOCTURNE_FFMPEG", "ffmpeg")
+
+# Output formats: file extension, content type and the ffmpeg arguments
+# encoding WAV on stdin to the format on stdout (None if no encode needed)
+FORMATS = {
+    "midi": ("mid", "audio/midi", None),
+    "wav": ("wav", "audio/wav", None),
+    "flac": ("flac", "audio/flac", ["-c:a", "flac", "-f", "flac"]),
+    "opus": ("ogg", "audio/ogg", ["-c:a", "libopus", "-b:a", "96k", "-f", "ogg"]),
+}
+DEFAULT_FORMAT = "wav"
+
+
+class EncodeError(Exception):
+    '''
+    Raised when the encoder process fails
+    '''
+
+
+def file_name(title, output_format):
+    '''
+    Get the file name for a song in a given format
+    '''
+    return "%s.%s" % (title, FORMATS[output_format][0])
+
+
+def content_type(output_format):
+    '''
+    Get the content type of a format
+    '''
+    return FORMATS[output_format][1]
+
+
+def encode(data, output_format):
+    '''
+    Encode rendered WAV (or MIDI) bytes to output_format, yielding chunks
+    of the encoded file as soon as the encoder produces them
+    '''
+    args = FORMATS[output_format][2]
+    if args is None:
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+        return
+    process = subprocess.Popen(
+        [ffmpeg, "-hide_banner", "-loglevel", "error",
+         "-f", "wav", "-i", "pipe:0", *args, "pipe:1"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def feed():
+        # The encoder exiting early closes the pipe, its error is reported
+        # from its exit status instead
+        try:
+            process.stdin.write(data)
+        except BrokenPipeError:
+            pass
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    # Writing on a separate thread stops a full stdout pipe from
+    # deadlocking the encoder while we are still sending it input
+    writer = threading.Thread(target=feed, daemon=True)
+    writer.start()
+    finished = False
+    try:
+        for chunk in iter(lambda: process.stdout.read(chunk_size), b""):
+            yield chunk
+        finished = True
+    finally:
+        if not finished:
+            # The consumer stopped early, the encoder may be blocked on a
+            # full stdout pipe and the writer on its stdin
+            process.stdout.close()
+            process.kill()
+            writer.join()
+            process.stderr.close()
+            process.wait()
+    writer.join()
+    process.stdout.close()
+    error = process.stderr.read()
+    process.stderr.close()
+    if process.wait() != 0:
+        raise EncodeError(error.decode(errors="replace").strip())
+
+
+if __name__ == "__main__":
+    # Bytes and render + encode latency per format for a 10 beat melody
+    import time
+    import note_parser
+    import renderer
+    from fake_openai import fake_melody
+
+    notes = note_parser.parse(fake_melody(20))
+    pool = renderer.RendererPool(workers=1)
+    pool.render(notes)  # warm up the synth process
+    for output_format in FORMATS:
+        start = time.perf_counter()
+        if output_format == "midi":
+            data = renderer.build_midi(notes)
+        else:
+            data = pool.render(notes)
+        size = sum(len(chunk) for chunk in encode(data, output_format))
+        print("%-5s %9d bytes %8.1f ms" % (
+            output_format, size, (time.perf_counter() - start) * 1000))
@@ -0,0 +1,138 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the OpenAI chat completions API, for benchmarking
+# generation latency offline. Point the app at it with
+#   OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=fake python3 app.py
+
+
+def fake_melody(notes=16):
+    '''
+    Build a melody in the note format the melody prompt asks for
+    '''
+    return "[" + ", ".join(
+        "{'note': %d, 'start_time': %.1f, 'duration': 0.5, 'velocity': %d}" % (
+            random.randint(48, 84), i * 0.5, random.randint(60, 110))
+        for i in range(notes)
+    ) + "]"
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    '''
+    Answers POST /v1/chat/completions after a configurable delay
+    '''
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(
+            int(self.headers.get("Content-Length", 0))))
+        server = self.server
+        # Streams take as long overall, with the first token after a tenth
+        streaming = body.get("stream", False)
+        time.sleep(server.latency / 10 if streaming else server.latency)
+        if random.random() < server.error_rate:
+            return self.respond(random.choice([429, 500, 503]), {
+                "error": {"message": "fake failure", "type": "server_error"}})
+        system = body["messages"][0]["content"]
+        contents = [fake_melody(server.notes) if "melody" in system else "Nocturne"
+                    for _ in range(body.get("n", 1))]
+        content = contents[0]
+        completion_tokens = sum(len(content.split()) for content in contents)
+        usage = {
+            "prompt_tokens": len(system.split()),
+            "completion_tokens": completion_tokens,
+            "total_tokens": len(system.split()) + completion_tokens,
+        }
+        if streaming:
+            return self.stream(body, content, usage)
+        self.respond(200, {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{
+                "index": i,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            } for i, content in enumerate(contents)],
+            "usage": usage,
+        })
+
+    def stream(self, body, content, usage):
+        '''
+        Send content word by word as server-sent completion chunks
+        '''
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        words = content.split(" ")
+        delay = self.server.latency * 0.9 / len(words)
+
+        def chunk(delta, finish_reason=None):
+            return {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model", "fake"),
+                "choices": [{"index": 0, "delta": delta,
+                             "finish_reason": finish_reason}],
+            }
+
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(delay)
+            self.send_event(chunk({"content": word if i == 0 else " " + word}))
+        self.send_event(chunk({}, "stop"))
+        if body.get("stream_options", {}).get("include_usage"):
+            self.send_event({**chunk({}), "choices": [], "usage": usage})
+        self.send_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def send_event(self, payload):
+        data = payload if isinstance(payload, str) else json.dumps(payload)
+        data = ("data: %s\n\n" % data).encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+    def respond(self, code, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host="127.0.0.1", port=0, latency=0.5, error_rate=0.0, notes=16):
+    '''
+    Start the fake server on a background thread and return it, the
+    bound address is available as server.server_address
+    '''
+    server = ThreadingHTTPServer((host, port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.error_rate = error_rate
+    server.notes = notes
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--notes", type=int, default=16)
+    args = parser.parse_args()
+    server = serve(args.host, args.port, args.latency,
+                   args.error_rate, args.notes)
+    print("Fake OpenAI listening on http://%s:%d/v1" % server.server_address)
+    threading.Event().wait()
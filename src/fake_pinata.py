@@ -0,0 +1,94 @@
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the Pinata pinning API, for tests and upload
+# benchmarks. Point the app at it with
+#   PINATA_URL=http://127.0.0.1:8002/pinning/pinFileToIPFS PINATA_JWT=fake python3 app.py
+
+
+class FakePinataHandler(BaseHTTPRequestHandler):
+    '''
+    Answers POST /pinning/pinFileToIPFS with a CID derived from the file
+    '''
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.read_body()
+        server = self.server
+        time.sleep(server.latency)
+        if random.random() < server.error_rate:
+            return self.respond(random.choice([429, 500, 503]),
+                                {"error": "fake failure"})
+        # The file is the first multipart part, between its headers and the
+        # closing boundary
+        start = body.find(b"\r\n\r\n") + 4
+        end = body.rfind(b"\r\n--")
+        content = body[start:end]
+        with server.lock:
+            server.pinned += 1
+            server.received += len(content)
+        self.respond(200, {
+            "IpfsHash": "bafk" + hashlib.sha256(content).hexdigest()[:52],
+            "PinSize": len(content),
+            "Timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        })
+
+    def read_body(self):
+        '''
+        Read the request body, plain or with chunked transfer encoding
+        '''
+        if self.headers.get("Transfer-Encoding", "").lower() != "chunked":
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b";")[0], 16)
+            if size == 0:
+                self.rfile.readline()
+                return b"".join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def respond(self, code, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host="127.0.0.1", port=0, latency=0.1, error_rate=0.0):
+    '''
+    Start the fake server on a background thread and return it, the
+    bound address is available as server.server_address
+    '''
+    server = ThreadingHTTPServer((host, port), FakePinataHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.error_rate = error_rate
+    server.lock = threading.Lock()
+    server.pinned = 0
+    server.received = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    server = serve(args.host, args.port, args.latency, args.error_rate)
+    print("Fake Pinata listening on http://%s:%d/pinning/pinFileToIPFS"
+          % server.server_address)
+    threading.Event().wait()
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_key(mood, genres, text, duration, output_format="wav"):
+    '''
+    Build the normalized cache key for a generation request
+    '''
+    normalized = {
+        "mood": (mood or "").strip().lower(),
+        "genres": sorted({genre.strip().lower() for genre in genres}),
+        "text": " ".join((text or "").lower().split()),
+        "duration": duration,
+        "format": output_format,
+    }
+    return hashlib.sha256(
+        json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+
+class GenerationCache:
+    '''
+    Size-bounded LRU cache with TTL of generated songs, keeping a pool of
+    up to `variants` different results for every request key
+    '''
+
+    def __init__(self, max_keys=1024, ttl=24 * 60 * 60, variants=1):
+        '''
+        Initialize a GenerationCache
+        '''
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.variants = variants
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        '''
+        Get a cached variant for key, or None on a miss. While the pool
+        for a key holds fewer than `variants` results every lookup is a
+        miss so that a new variant gets generated.
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry["created"] > self.ttl:
+                del self.entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None or len(entry["pool"]) < self.variants:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return random.choice(entry["pool"])
+
+    def put(self, key, notes, title, file_hash, cid):
+        '''
+        Add a generated variant to the pool for key
+        '''
+        variant = {
+            "notes": notes,
+            "title": title,
+            "file_hash": file_hash,
+            "cid": cid,
+        }
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = {"created": time.monotonic(), "pool": []}
+                self.entries[key] = entry
+            self.entries.move_to_end(key)
+            if len(entry["pool"]) < self.variants:
+                entry["pool"].append(variant)
+            while len(self.entries) > self.max_keys:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def set_cid(self, file_hash, cid):
+        '''
+        Record the IPFS CID of a cached file once it has been pinned
+        '''
+        with self.lock:
+            for entry in self.entries.values():
+                for variant in entry["pool"]:
+                    if variant["file_hash"] == file_hash:
+                        variant["cid"] = cid
+
+    def discard(self, file_hash):
+        '''
+        Drop every cached variant of a file, for files that will not be
+        pinned and may be evicted from the blob store
+        '''
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                entry["pool"] = [variant for variant in entry["pool"]
+                                 if variant["file_hash"] != file_hash]
+                if not entry["pool"]:
+                    del self.entries[key]
+
+    def stats(self):
+        '''
+        Get the hit/miss counters of the cache
+        '''
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "keys": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
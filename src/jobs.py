@@ -0,0 +1,510 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from db import db
+from db import Query
+import admission
+import config
+import encoders
+import generation_cache
+import gpt4_querier
+import note_parser
+import pinata_integration
+import renderer
+import telemetry
+
+########## Query statuses ##########
+
+PENDING = "pending"
+GENERATING = "generating"
+RENDERING = "rendering"
+DONE = "done"
+FAILED = "failed"
+
+
+class QueueFull(Exception):
+    '''
+    Raised when the job queue cannot accept any more work
+    '''
+
+
+class JobQueue:
+    '''
+    In-process queue running the generate -> render pipeline for queries
+    on a bounded pool of worker threads. Rendered audio goes to the blob
+    store, where it can be played right away, and is pinned to IPFS in
+    the background by the pinner.
+    '''
+
+    def __init__(self, app, renderer, store, pinner, workers=4, max_pending=100,
+                 cache=None, streams=None):
+        '''
+        Initialize a JobQueue for the given Flask app rendering audio on
+        renderer, results are added to cache when one is given and
+        melodies are streamed to the channels of streams
+        '''
+        self.app = app
+        self.renderer = renderer
+        self.store = store
+        self.pinner = pinner
+        self.cache = cache
+        self.streams = streams
+        self.workers = workers
+        # Users take turns, so a burst from one does not starve the others
+        self.pending = admission.FairQueue(maxsize=max_pending)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.unfinished = 0
+
+    def start(self):
+        '''
+        Start the worker threads
+        '''
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self.work, name="query-worker-%d" % i, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, query_id, user_id=None):
+        '''
+        Queue a query of a user for generation, raising QueueFull if
+        saturated
+        '''
+        try:
+            self.pending.put_nowait(user_id, query_id)
+        except queue.Full:
+            raise QueueFull()
+        with self.lock:
+            self.unfinished += 1
+
+    def in_flight(self):
+        '''
+        Get the number of queries queued or being generated
+        '''
+        with self.lock:
+            return self.unfinished
+
+    def finished(self):
+        '''
+        Count a query as no longer in flight
+        '''
+        with self.lock:
+            self.unfinished -= 1
+
+    def work(self):
+        '''
+        Worker loop pulling query ids off the queue
+        '''
+        while True:
+            query_id = self.pending.get()
+            try:
+                self.run(query_id)
+            except Exception:
+                # The query was deleted while it was being generated, the
+                # worker carries on with the next one
+                pass
+            finally:
+                self.finished()
+
+    def run(self, query_id):
+        '''
+        Run every stage of the pipeline for a query, recording the status
+        and time spent in each stage on the Query row
+        '''
+        with self.app.app_context():
+            query = db.session.get(Query, query_id)
+            if query is None:
+                return
+            channel = self.channel(query_id)
+            try:
+                genres = [genre.genre for genre in query.genres]
+                with stage(query, GENERATING, "generating_time"):
+                    if channel is None:
+                        notes, name = gpt4_querier.generate_midi(
+                            query.mood, genres, query.text, query.duration)
+                    else:
+                        notes, name = gpt4_querier.stream_midi(
+                            query.mood, genres, query.text, query.duration,
+                            channel.feed)
+                if channel is not None:
+                    channel.publish("status", {"status": RENDERING, "title": name})
+                with stage(query, RENDERING, "rendering_time"):
+                    blob_hash = self.produce(
+                        notes if channel is None else channel.notes(),
+                        query.output_format)
+                query.title = name
+                query.blob_hash = blob_hash
+                query.status = DONE
+                self.remember(query, genres, notes)
+            except Exception as e:
+                db.session.rollback()
+                query.status = FAILED
+                query.error = str(e)
+            db.session.commit()
+            if channel is not None:
+                self.finish(channel, query)
+            if query.status == DONE:
+                self.pinner.submit(query.id)
+
+    def channel(self, query_id):
+        '''
+        Get the note stream of a query, or None if it is not streamed
+        '''
+        if self.streams is None:
+            return None
+        return self.streams.get(query_id)
+
+    def finish(self, channel, query):
+        '''
+        End the note stream of a query with its final state
+        '''
+        channel.close(query.status, {
+            "id": query.id,
+            "title": query.title,
+            "audio_url": query.audio_url(),
+            **query.serialize_status(),
+        })
+
+    def depth(self):
+        '''
+        Get the number of queries waiting for a worker
+        '''
+        return self.pending.qsize()
+
+    def produce(self, notes, output_format):
+        '''
+        Render notes (a NoteArray or raw LLM output) in output_format into the blob store, held until it
+        is pinned, and return the blob hash
+        '''
+        if output_format == "midi":
+            with telemetry.timer(telemetry.stage_seconds, stage="midi_build"):
+                if not isinstance(notes, note_parser.NoteArray):
+                    notes = note_parser.parse(notes)
+                audio = renderer.build_midi(notes)
+        else:
+            with telemetry.timer(telemetry.stage_seconds, stage="synthesis"):
+                audio = self.renderer.render(notes)
+        with telemetry.timer(telemetry.stage_seconds, stage="encode"):
+            return self.store.put(encoders.encode(audio, output_format), hold=True)
+
+    def remember(self, query, genres, notes):
+        '''
+        Add a finished query to the generation cache, if there is one
+        '''
+        if self.cache is not None:
+            self.cache.put(
+                generation_cache.make_key(
+                    query.mood, genres, query.text, query.duration,
+                    query.output_format),
+                notes, query.title, query.blob_hash, None)
+
+
+class AsyncJobQueue(JobQueue):
+    '''
+    JobQueue running the pipeline as coroutines on an event loop thread,
+    with the async OpenAI client and an asyncio database session, so one
+    process can hold hundreds of generations waiting on the LLM. Rendering
+    still runs on the renderer pool, through a thread of the loop.
+    '''
+
+    def __init__(self, app, renderer, store, pinner, workers=200,
+                 max_pending=1000, cache=None, streams=None):
+        '''
+        Initialize an AsyncJobQueue running at most `workers` generations
+        at once, with up to max_pending more waiting for a slot
+        '''
+        super().__init__(app, renderer, store, pinner, workers, max_pending,
+                         cache, streams)
+        self.loop = None
+        self.engine = None
+        # Only used on the loop
+        self.running = 0
+        self.tasks = set()
+
+    def start(self):
+        '''
+        Start the event loop thread
+        '''
+        with self.app.app_context():
+            url = config.async_database_url(db.engine.url)
+        self.engine = create_async_engine(
+            url, **config.database_config()["SQLALCHEMY_ENGINE_OPTIONS"])
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(
+            target=self.loop.run_forever, name="query-loop", daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def submit(self, query_id, user_id=None):
+        '''
+        Queue a query of a user for generation, raising QueueFull if
+        saturated
+        '''
+        super().submit(query_id, user_id)
+        self.loop.call_soon_threadsafe(self.dispatch)
+
+    def dispatch(self):
+        '''
+        Start queued queries while there are free slots, on the loop
+        '''
+        while self.running < self.workers:
+            try:
+                query_id = self.pending.get_nowait()
+            except queue.Empty:
+                return
+            self.running += 1
+            task = self.loop.create_task(self.arun(query_id))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def arun(self, query_id):
+        '''
+        Run the pipeline for a query in one of the slots
+        '''
+        try:
+            await self.agenerate(query_id)
+        finally:
+            self.running -= 1
+            self.finished()
+            self.dispatch()
+
+    async def agenerate(self, query_id):
+        '''
+        run() as a coroutine
+        '''
+        loop = asyncio.get_running_loop()
+        async with AsyncSession(self.engine, expire_on_commit=False) as session:
+            query = await session.get(Query, query_id)
+            if query is None:
+                return
+            channel = self.channel(query_id)
+            try:
+                genres = [genre.genre for genre in query.genres]
+                async with astage(session, query, GENERATING, "generating_time"):
+                    if channel is None:
+                        notes, name = await gpt4_querier.agenerate_midi(
+                            query.mood, genres, query.text, query.duration)
+                    else:
+                        notes, name = await gpt4_querier.astream_midi(
+                            query.mood, genres, query.text, query.duration,
+                            channel.feed)
+                if channel is not None:
+                    channel.publish("status", {"status": RENDERING, "title": name})
+                async with astage(session, query, RENDERING, "rendering_time"):
+                    blob_hash = await loop.run_in_executor(
+                        None, self.produce,
+                        notes if channel is None else channel.notes(),
+                        query.output_format)
+                query.title = name
+                query.blob_hash = blob_hash
+                query.status = DONE
+                self.remember(query, genres, notes)
+            except Exception as e:
+                await session.rollback()
+                query.status = FAILED
+                query.error = str(e)
+            await session.commit()
+            if channel is not None:
+                # A rollback expired the attributes, which cannot be
+                # loaded lazily here
+                await session.refresh(query)
+                self.finish(channel, query)
+            if query.status == DONE:
+                self.pinner.submit(query_id)
+
+
+class Pinner:
+    '''
+    Background stage pinning rendered audio to IPFS in batches and filling
+    in the pinata_url of the queries it belongs to
+    '''
+
+    def __init__(self, app, store, batch_size=16, interval=2.0, max_attempts=5,
+                 cache=None):
+        '''
+        Initialize a Pinner uploading blobs from store, collecting up to
+        batch_size queries or waiting at most interval seconds per batch,
+        CIDs are recorded in cache when one is given
+        '''
+        self.app = app
+        self.store = store
+        self.cache = cache
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.attempts = {}
+        self.pending = queue.Queue()
+        self.executor = ThreadPoolExecutor(
+            max_workers=pinata_integration.max_concurrent,
+            thread_name_prefix="pinner-upload")
+
+    def start(self):
+        '''
+        Start pinning, picking up queries left unpinned by a restart
+        '''
+        with self.app.app_context():
+            unpinned = Query.query.filter(
+                Query.status == DONE, Query.pinata_url == '',
+                Query.blob_hash.isnot(None))
+            for query in unpinned:
+                self.submit(query.id)
+        threading.Thread(target=self.work, name="pinner", daemon=True).start()
+
+    def submit(self, query_id):
+        '''
+        Queue a finished query for pinning
+        '''
+        self.pending.put(query_id)
+
+    def work(self):
+        '''
+        Loop collecting batches of queries and pinning them
+        '''
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.pending.get(
+                        timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.pin(batch)
+            except Exception:
+                time.sleep(self.interval)
+                abandoned = [query_id for query_id in batch if not self.retry(query_id)]
+                if abandoned:
+                    self.abandon(abandoned)
+
+    def retry(self, query_id):
+        '''
+        Queue a query again after a failed pin, giving up after
+        max_attempts, returns whether it was queued
+        '''
+        self.attempts[query_id] = self.attempts.get(query_id, 0) + 1
+        if self.attempts[query_id] >= self.max_attempts:
+            del self.attempts[query_id]
+            return False
+        self.pending.put(query_id)
+        return True
+
+    def abandon(self, query_ids):
+        '''
+        Give up on the blobs of queries that will not be pinned
+        '''
+        try:
+            with self.app.app_context():
+                for (blob_hash,) in db.session.query(Query.blob_hash).filter(
+                        Query.id.in_(query_ids), Query.blob_hash.isnot(None)):
+                    self.give_up(blob_hash)
+        except Exception:
+            pass
+
+    def give_up(self, blob_hash):
+        '''
+        Let a blob that will not be pinned be evicted again, and stop
+        answering cache hits with it since it may soon be gone
+        '''
+        self.store.release(blob_hash)
+        if self.cache is not None:
+            self.cache.discard(blob_hash)
+
+    def pin(self, query_ids):
+        '''
+        Upload every distinct blob of a batch concurrently and record the
+        CIDs on all queries sharing it
+        '''
+        with self.app.app_context():
+            by_blob = {}
+            for query in Query.query.filter(Query.id.in_(query_ids)):
+                if query.blob_hash and not query.pinata_url:
+                    self.store.hold(query.blob_hash)
+                    by_blob.setdefault(query.blob_hash, []).append(query)
+            uploads = {
+                blob_hash: self.executor.submit(self.upload, blob_hash, queries[0])
+                for blob_hash, queries in by_blob.items()
+            }
+            for blob_hash, upload in uploads.items():
+                try:
+                    cid, elapsed = upload.result()
+                except Exception as e:
+                    queued = False
+                    for query in by_blob[blob_hash]:
+                        if self.retry(query.id):
+                            queued = True
+                        else:
+                            query.error = "Pinning failed: %s" % e
+                    # Held until pinned, which will not happen any more
+                    if not queued:
+                        self.give_up(blob_hash)
+                    continue
+                for query in by_blob[blob_hash]:
+                    query.pinata_url = "ipfs.io/ipfs/" + cid
+                    query.uploading_time = elapsed
+                    self.attempts.pop(query.id, None)
+                self.store.release(blob_hash)
+                if self.cache is not None:
+                    self.cache.set_cid(blob_hash, cid)
+            db.session.commit()
+
+    def upload(self, blob_hash, query):
+        '''
+        Pin one blob, returning its CID and the time taken
+        '''
+        start = time.perf_counter()
+        cid = pinata_integration.upload_pinata_stream(
+            lambda: self.store.read(blob_hash),
+            encoders.file_name(query.title, query.output_format),
+            encoders.content_type(query.output_format),
+            blob_hash)
+        elapsed = time.perf_counter() - start
+        telemetry.stage_seconds.observe(elapsed, stage="upload")
+        return cid, elapsed
+
+
+class stage:
+    '''
+    Context manager marking a query as being in a stage and timing it
+    '''
+
+    def __init__(self, query, status, timing_field):
+        self.query = query
+        self.status = status
+        self.timing_field = timing_field
+
+    def __enter__(self):
+        self.query.status = self.status
+        db.session.commit()
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, tb):
+        setattr(self.query, self.timing_field,
+                time.perf_counter() - self.start)
+        return False
+
+
+class astage:
+    '''
+    stage for an asyncio session
+    '''
+
+    def __init__(self, session, query, status, timing_field):
+        self.session = session
+        self.query = query
+        self.status = status
+        self.timing_field = timing_field
+
+    async def __aenter__(self):
+        self.query.status = self.status
+        await self.session.commit()
+        self.start = time.perf_counter()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        setattr(self.query, self.timing_field,
+                time.perf_counter() - self.start)
+        return False
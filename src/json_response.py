@@ -0,0 +1,165 @@
+import gzip
+import json
+import os
+import types
+import zlib
+from flask import Response, request, stream_with_context
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this go out uncompressed
+compress_min_bytes = int(os.environ.get("NOCTURNE_COMPRESS_MIN_BYTES", 1024))
+gzip_level = 6
+brotli_quality = 4
+
+
+def dumps(data):
+    '''
+    Encode data to JSON bytes with orjson when it is installed
+    '''
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode()
+
+
+def is_stream(value):
+    return isinstance(value, types.GeneratorType)
+
+
+def stream(data):
+    '''
+    Encode a dict to JSON chunk by chunk. Generator values are written as
+    arrays one item at a time and callable values are only called once
+    everything before them is written, so a whole collection is never
+    held in memory.
+    '''
+    yield b"{"
+    for i, (key, value) in enumerate(data.items()):
+        yield (b"," if i else b"") + dumps(key) + b":"
+        if callable(value):
+            value = value()
+        if not is_stream(value):
+            yield dumps(value)
+            continue
+        yield b"["
+        for j, item in enumerate(value):
+            yield (b"," if j else b"") + dumps(item)
+        yield b"]"
+    yield b"}"
+
+
+def success_response(data, code=200):
+    '''
+    Build a JSON response, streamed if any value of data is a generator
+    '''
+    if isinstance(data, dict) and any(is_stream(value) for value in data.values()):
+        return Response(stream_with_context(stream(data)), code,
+                        mimetype="application/json")
+    return Response(dumps(data), code, mimetype="application/json")
+
+
+def failure_response(message, code=404):
+    return success_response({"error": message}, code)
+
+
+def negotiate():
+    '''
+    Pick the best encoding the client accepts, or None
+    '''
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+
+def compress_stream(chunks, encoding):
+    '''
+    Compress a stream of chunks as they are produced
+    '''
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=brotli_quality)
+        for chunk in chunks:
+            output = compressor.process(chunk)
+            if output:
+                yield output
+        yield compressor.finish()
+        return
+    compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        output = compressor.compress(chunk)
+        if output:
+            yield output
+    yield compressor.flush()
+
+
+def compress(response):
+    '''
+    after_request hook compressing JSON responses for clients that accept
+    it, streamed ones included
+    '''
+    if (response.mimetype != "application/json" or response.status_code == 304
+            or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+    else:
+        data = response.get_data()
+        if len(data) < compress_min_bytes:
+            return response
+        if encoding == "br":
+            response.set_data(brotli.compress(data, quality=brotli_quality))
+        else:
+            response.set_data(gzip.compress(data, gzip_level))
+    response.headers["Content-Encoding"] = encoding
+    # The compressed body is a different representation of the same data
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+if __name__ == "__main__":
+    # Bytes on the wire and serialization time for a 10k song response
+    import statistics
+    import time
+
+    songs = {"songs": [{
+        "id": i,
+        "title": "Song %d" % i,
+        "likes": i % 100,
+        "user_id": i % 1000,
+        "mood": "calm",
+        "genres": [{"id": 1, "genre": "lofi"}, {"id": 2, "genre": "jazz"}],
+    } for i in range(10000)], "next_cursor": None}
+
+    encoders = [("json", lambda data: json.dumps(data).encode())]
+    if orjson is not None:
+        encoders.append(("orjson", orjson.dumps))
+    for name, encode in encoders:
+        timings = []
+        for _ in range(100):
+            start = time.perf_counter()
+            encode(songs)
+            timings.append(time.perf_counter() - start)
+        print("%-7s p50 %6.2f ms  p99 %6.2f ms" % (
+            name, statistics.median(timings) * 1000,
+            statistics.quantiles(timings, n=100)[98] * 1000))
+    data = dumps(songs)
+    print("identity %9d bytes" % len(data))
+    print("gzip     %9d bytes" % len(gzip.compress(data, gzip_level)))
+    if brotli is not None:
+        print("br       %9d bytes" % len(brotli.compress(data, quality=brotli_quality)))
@@ -0,0 +1,358 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import requests
+import fake_openai
+import fake_pinata
+
+# End-to-end load test. Seeds a database, serves the app with serve.py
+# against the fake OpenAI and Pinata servers and a silent stand-in synth,
+# drives a mix of reads, writes and generations at a fixed concurrency and
+# writes latency percentiles and throughput per route to a JSON file.
+#   python3 loadtest.py --scale 100k --concurrency 32 --duration 60
+#   python3 loadtest.py --scale 1m --database /tmp/nocturne-1m.db
+# A database given with --database is seeded once and reused by later
+# runs. Compare runs by diffing their output files.
+
+SCALES = {"1k": 1000, "100k": 100000, "1m": 1000000}
+songs_per_user = 10
+genre_count = 50
+seed_batch_size = 10000
+
+# Route -> weight in the traffic mix
+MIX = {
+    "GET /api/songs/": 15,
+    # Keyset pages from a random point in the table, their latency should
+    # match the first page's at any scale
+    "GET /api/songs/?cursor=": 10,
+    "GET /api/songs/<id>/": 20,
+    "GET /api/users/<id>/": 15,
+    "GET /api/songs/recommendations/": 15,
+    "GET /api/genres/": 5,
+    "POST /api/songs/": 10,
+    "POST /api/queries/": 10,
+}
+
+
+def seed(scale):
+    '''
+    Fill an empty database with `scale` songs, one user per
+    songs_per_user songs and genre_count genres, then return the number
+    of users and songs in it
+    '''
+    from flask import Flask
+    from sqlalchemy import func
+    import config
+    import migrations
+    import moods
+    from db import db, User, Genre, Song, association_table8
+
+    app = Flask("app")
+    app.config.from_mapping(config.database_config())
+    db.init_app(app)
+    rng = random.Random(0)
+    words = list(moods.LEXICON)
+    with app.app_context():
+        migrations.upgrade(db)
+        if not db.session.query(func.count(Song.id)).scalar():
+            users = max(1, scale // songs_per_user)
+            with db.engine.begin() as conn:
+                conn.execute(Genre.__table__.insert(), [
+                    {"id": i, "genre": "genre %d" % i}
+                    for i in range(1, genre_count + 1)])
+                for start in range(1, users + 1, seed_batch_size):
+                    conn.execute(User.__table__.insert(), [
+                        {"id": i, "username": "user%d" % i,
+                         "email": "user%d@example.com" % i, "hashed_password": "x"}
+                        for i in range(start, min(users + 1, start + seed_batch_size))])
+                for start in range(1, scale + 1, seed_batch_size):
+                    ids = range(start, min(scale + 1, start + seed_batch_size))
+                    conn.execute(Song.__table__.insert(), [
+                        {"id": i, "title": "song %d" % i, "likes": rng.randint(0, 1000),
+                         "user_id": rng.randint(1, users), "mood": rng.choice(words)}
+                        for i in ids])
+                    conn.execute(association_table8.insert(), [
+                        {"song_id": i, "genre_id": genre_id} for i in ids
+                        for genre_id in rng.sample(range(1, genre_count + 1),
+                                                   rng.randint(1, 2))])
+        return (db.session.query(func.count(User.id)).scalar(),
+                db.session.query(func.count(Song.id)).scalar())
+
+
+def last_query_id(engine):
+    '''
+    Get the id of the latest query, generations of a run come after it
+    '''
+    from sqlalchemy import text
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT MAX(id) FROM queries")).scalar() or 0
+
+
+def build_request(route, rng, users, songs, words, output_format):
+    '''
+    Get the method, path and JSON body of a random request to route
+    '''
+    mood = rng.choice(words)
+    if route == "GET /api/songs/":
+        if rng.random() < 0.5:
+            return "GET", "/api/songs/?limit=50", None
+        return "GET", "/api/songs/?limit=50&genre_id=%d" % rng.randint(1, genre_count), None
+    if route == "GET /api/songs/?cursor=":
+        from pagination import encode_cursor
+        cursor = encode_cursor(rng.randint(0, max(0, songs - 50)))
+        if rng.random() < 0.5:
+            return "GET", "/api/songs/?limit=50&cursor=%s" % cursor, None
+        return "GET", "/api/songs/?limit=50&genre_id=%d&cursor=%s" % (
+            rng.randint(1, genre_count), cursor), None
+    if route == "GET /api/songs/<id>/":
+        return "GET", "/api/songs/%d/" % rng.randint(1, songs), None
+    if route == "GET /api/users/<id>/":
+        return "GET", "/api/users/%d/" % rng.randint(1, users), None
+    if route == "GET /api/songs/recommendations/":
+        return "GET", "/api/songs/recommendations/?k=10&mood=%s" % mood, None
+    if route == "GET /api/genres/":
+        return "GET", "/api/genres/", None
+    if route == "POST /api/songs/":
+        return "POST", "/api/songs/", {
+            "title": "loadtest %d" % rng.getrandbits(32),
+            "user_id": rng.randint(1, users),
+            "mood": mood,
+            "genre_ids": [rng.randint(1, genre_count)],
+        }
+    return "POST", "/api/queries/", {
+        "query": "loadtest %d" % rng.getrandbits(32),
+        "user_id": rng.randint(1, users),
+        "mood": mood,
+        "genres": ["genre %d" % rng.randint(1, genre_count)],
+        "duration": 10,
+        "format": output_format,
+    }
+
+
+def percentile(values, q):
+    '''
+    Nearest-rank percentile of sorted values
+    '''
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q / 100.0 * len(values)))]
+
+
+def ms(values, q):
+    '''
+    Percentile of sorted values in milliseconds
+    '''
+    value = percentile(values, q)
+    return None if value is None else value * 1000
+
+
+def summarize(latencies, errors, rejected, duration):
+    '''
+    Get the throughput and latency percentiles (ms) of a list of latencies
+    '''
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rejected": rejected,
+        "rps": len(latencies) / duration,
+        "p50_ms": ms(latencies, 50),
+        "p95_ms": ms(latencies, 95),
+        "p99_ms": ms(latencies, 99),
+        "max_ms": latencies[-1] * 1000 if latencies else None,
+    }
+
+
+def drive(base, args, users, songs):
+    '''
+    Run args.concurrency clients for the warmup and the measured duration,
+    returning the latencies, error counts and 429 counts per route
+    '''
+    import moods
+
+    words = list(moods.LEXICON)
+    routes = list(MIX)
+    weights = [MIX[route] for route in routes]
+    measure_from = time.perf_counter() + args.warmup
+    stop_at = measure_from + args.duration
+    results = []
+
+    def client(number):
+        rng = random.Random(number)
+        session = requests.Session()
+        latencies = {route: [] for route in routes}
+        errors = {route: 0 for route in routes}
+        rejected = {route: 0 for route in routes}
+        while True:
+            route = rng.choices(routes, weights)[0]
+            method, path, body = build_request(
+                route, rng, users, songs, words, args.format)
+            start = time.perf_counter()
+            if start >= stop_at:
+                break
+            try:
+                response = session.request(
+                    method, base + path, json=body, timeout=120)
+                status = response.status_code
+            except requests.RequestException:
+                status = None
+            if start >= measure_from:
+                latencies[route].append(time.perf_counter() - start)
+                # Admission control turning requests away is not an error
+                if status == 429:
+                    rejected[route] += 1
+                elif status is None or status >= 400:
+                    errors[route] += 1
+        results.append((latencies, errors, rejected))
+
+    threads = [threading.Thread(target=client, args=(number,))
+               for number in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies = {route: [] for route in routes}
+    errors = {route: 0 for route in routes}
+    rejected = {route: 0 for route in routes}
+    for client_latencies, client_errors, client_rejected in results:
+        for route in routes:
+            latencies[route].extend(client_latencies[route])
+            errors[route] += client_errors[route]
+            rejected[route] += client_rejected[route]
+    return latencies, errors, rejected
+
+
+def generation_stats(engine, after_id, drain):
+    '''
+    Wait up to drain seconds for the generations of the run to finish and
+    summarize their stage timings
+    '''
+    from sqlalchemy import text
+    deadline = time.monotonic() + drain
+    with engine.connect() as conn:
+        while time.monotonic() < deadline and conn.execute(text(
+                "SELECT COUNT(*) FROM queries WHERE id > :id "
+                "AND status NOT IN ('done', 'failed')"), {"id": after_id}).scalar():
+            time.sleep(0.5)
+        rows = conn.execute(text(
+            "SELECT status, generating_time, rendering_time, uploading_time "
+            "FROM queries WHERE id > :id"), {"id": after_id}).fetchall()
+    stats = {
+        "submitted": len(rows),
+        "done": sum(1 for row in rows if row[0] == "done"),
+        "failed": sum(1 for row in rows if row[0] == "failed"),
+        "pinned": sum(1 for row in rows if row[3] is not None),
+    }
+    stats["unfinished"] = stats["submitted"] - stats["done"] - stats["failed"]
+    for name, values in [
+        ("generating", [row[1] for row in rows if row[1] is not None]),
+        ("rendering", [row[2] for row in rows if row[2] is not None]),
+        ("uploading", [row[3] for row in rows if row[3] is not None]),
+        ("total", [row[1] + row[2] for row in rows
+                   if row[1] is not None and row[2] is not None]),
+    ]:
+        values.sort()
+        stats[name] = {
+            "p50_ms": ms(values, 50),
+            "p95_ms": ms(values, 95),
+            "p99_ms": ms(values, 99),
+        }
+    return stats
+
+
+def main(args):
+    openai_server = fake_openai.serve(
+        latency=args.openai_latency, error_rate=args.openai_error_rate)
+    pinata_server = fake_pinata.serve(
+        latency=args.pinata_latency, error_rate=args.pinata_error_rate)
+    scratch = tempfile.mkdtemp(prefix="nocturne-loadtest-")
+    database = os.path.abspath(args.database or os.path.join(scratch, "loadtest.db"))
+    os.environ.update({
+        "DATABASE_URL": "sqlite:///" + database,
+        "OPENAI_BASE_URL": "http://%s:%d/v1" % openai_server.server_address,
+        "OPENAI_API_KEY": "fake",
+        "PINATA_JWT": "fake",
+        "PINATA_URL": "http://%s:%d/pinning/pinFileToIPFS"
+        % pinata_server.server_address,
+        "NOCTURNE_BLOB_DIR": os.path.join(scratch, "blobs"),
+        "NOCTURNE_FAKE_SYNTH": "1",
+        "NOCTURNE_ASYNC_JOBS": "0" if args.sync else "1",
+        "NOCTURNE_JOB_QUEUE_SIZE": "100000",
+    })
+    print("seeding %s songs into %s" % (args.scale, database))
+    users, songs = seed(SCALES[args.scale])
+
+    from sqlalchemy import create_engine
+    engine = create_engine(os.environ["DATABASE_URL"])
+    after_id = last_query_id(engine)
+    base = "http://127.0.0.1:%d" % args.port
+    server = subprocess.Popen([
+        sys.executable, "serve.py", "--host", "127.0.0.1",
+        "--port", str(args.port)],
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        deadline = time.monotonic() + 300
+        while True:
+            try:
+                if requests.get(base + "/api/genres/", timeout=5).ok:
+                    break
+            except requests.RequestException:
+                pass
+            if server.poll() is not None or time.monotonic() > deadline:
+                raise SystemExit("server did not start")
+            time.sleep(0.5)
+        print("driving %d clients for %ds after a %ds warmup" % (
+            args.concurrency, args.duration, args.warmup))
+        latencies, errors, rejected = drive(base, args, users, songs)
+        generations = generation_stats(engine, after_id, args.drain)
+    finally:
+        server.terminate()
+        server.wait()
+
+    report = {
+        "config": {**vars(args), "users": users, "songs": songs},
+        "routes": {route: summarize(latencies[route], errors[route],
+                                    rejected[route], args.duration)
+                   for route in MIX},
+        "total": summarize(
+            [latency for route in MIX for latency in latencies[route]],
+            sum(errors.values()), sum(rejected.values()), args.duration),
+        "generations": generations,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    for route, stats in list(report["routes"].items()) + [("total", report["total"])]:
+        print("%-34s %8.1f rps  p50 %8.1f  p95 %8.1f  p99 %8.1f ms  "
+              "%d errors  %d rejected" % (
+                  route, stats["rps"], stats["p50_ms"] or 0, stats["p95_ms"] or 0,
+                  stats["p99_ms"] or 0, stats["errors"], stats["rejected"]))
+    print("generations: %(submitted)d submitted, %(done)d done, "
+          "%(failed)d failed, %(unfinished)d unfinished" % generations)
+    print("report written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", choices=SCALES, default="1k")
+    parser.add_argument("--database", help="SQLite file to seed once and reuse")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=5)
+    parser.add_argument("--drain", type=float, default=60,
+                        help="seconds to wait for generations after the run")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--format", default="midi")
+    parser.add_argument("--sync", action="store_true",
+                        help="use the threaded job queue")
+    parser.add_argument("--openai-latency", type=float, default=1.0)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--pinata-latency", type=float, default=0.2)
+    parser.add_argument("--pinata-error-rate", type=float, default=0.0)
+    parser.add_argument("--output", default="loadtest.json")
+    main(parser.parse_args())
@@ -0,0 +1,170 @@
+from sqlalchemy import Boolean, Column, ForeignKey, Index, Integer, MetaData, \
+    String, Table, inspect, text
+
+# Versioned schema upgrades for existing databases. A fresh database is
+# created from the models by db.create_all() and stamped with the latest
+# version, an existing one runs every migration after its stored version.
+# Databases from before versioning have no schema_version table and are
+# treated as version 0.
+
+
+class MigrationError(Exception):
+    '''
+    Raised when existing data prevents a migration, the upgrade is rolled
+    back and the message says what to fix
+    '''
+
+
+def add_query_job_columns(conn):
+    '''
+    Add the generation status, timing and format columns to queries,
+    rows from before the job queue were generated synchronously so they
+    are all done
+    '''
+    columns = {column["name"] for column in inspect(conn).get_columns("queries")}
+    for name, definition in [
+        ("duration", "INTEGER NOT NULL DEFAULT 10"),
+        ("output_format", "VARCHAR(10) NOT NULL DEFAULT 'wav'"),
+        ("title", "VARCHAR(80) DEFAULT ''"),
+        ("status", "VARCHAR(20) NOT NULL DEFAULT 'done'"),
+        ("error", "VARCHAR DEFAULT ''"),
+        ("generating_time", "FLOAT"),
+        ("rendering_time", "FLOAT"),
+        ("uploading_time", "FLOAT"),
+    ]:
+        if name not in columns:
+            conn.execute(text(
+                "ALTER TABLE queries ADD COLUMN %s %s" % (name, definition)))
+
+
+def add_keys_and_indexes(conn):
+    '''
+    Rebuild the association tables with composite primary keys, dropping
+    duplicate links, and index foreign keys and user emails
+    '''
+    for table, column, parent in [
+        ("user_genre_association", "user_id", "users"),
+        ("query_genre_association", "query_id", "queries"),
+        ("song_genre_association", "song_id", "songs"),
+    ]:
+        conn.execute(text("ALTER TABLE %s RENAME TO %s_old" % (table, table)))
+        conn.execute(text(
+            "CREATE TABLE %(table)s ("
+            "%(column)s INTEGER NOT NULL "
+            "REFERENCES %(parent)s (id) ON DELETE CASCADE, "
+            "genre_id INTEGER NOT NULL "
+            "REFERENCES genres (id) ON DELETE CASCADE, "
+            "PRIMARY KEY (%(column)s, genre_id))"
+            % {"table": table, "column": column, "parent": parent}))
+        conn.execute(text(
+            "INSERT INTO %(table)s (%(column)s, genre_id) "
+            "SELECT DISTINCT %(column)s, genre_id FROM %(table)s_old "
+            "WHERE %(column)s IS NOT NULL AND genre_id IS NOT NULL"
+            % {"table": table, "column": column}))
+        conn.execute(text("DROP TABLE %s_old" % table))
+        conn.execute(text(
+            "CREATE INDEX ix_%s_genre_id ON %s (genre_id)" % (table, table)))
+    conn.execute(text("CREATE INDEX ix_songs_user_id ON songs (user_id)"))
+    conn.execute(text("CREATE INDEX ix_queries_user_id ON queries (user_id)"))
+    # Emails were not unique before, which accounts to keep is for the
+    # operator to decide
+    duplicates = conn.execute(text(
+        "SELECT email, COUNT(*) FROM users GROUP BY email HAVING COUNT(*) > 1 "
+        "ORDER BY email LIMIT 20")).fetchall()
+    if duplicates:
+        raise MigrationError(
+            "Cannot make user emails unique, these are used by several users: "
+            + ", ".join("%s (%d users)" % (email, count) for email, count in duplicates)
+            + ". Change or delete the extra users and restart.")
+    conn.execute(text("CREATE UNIQUE INDEX ix_users_email ON users (email)"))
+
+
+def add_query_blob_hash(conn):
+    '''
+    Add the blob store hash of the rendered audio to queries
+    '''
+    conn.execute(text("ALTER TABLE queries ADD COLUMN blob_hash VARCHAR(64)"))
+
+
+def add_pregenerated_table(conn):
+    '''
+    Add the pool of pre-generated songs, unless the database was created
+    with it already
+    '''
+    if "pregenerated" in inspect(conn).get_table_names():
+        return
+    # Defined here rather than taken from the model, so that later model
+    # changes do not alter what this migration creates
+    metadata = MetaData()
+    Table("genres", metadata, Column("id", Integer, primary_key=True))
+    Table(
+        "pregenerated", metadata,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("mood", String(80), nullable=False),
+        Column("genre_id", Integer, ForeignKey("genres.id", ondelete="CASCADE")),
+        Column("duration", Integer, nullable=False),
+        Column("output_format", String(10), nullable=False),
+        Column("title", String(80), default=""),
+        Column("blob_hash", String(64), nullable=False),
+        Column("used", Boolean, nullable=False, default=False),
+        Index("ix_pregenerated_lookup",
+              "mood", "genre_id", "output_format", "duration", "used"),
+    ).create(conn)
+
+
+# Append only, the position of a migration in this list is its version
+MIGRATIONS = [
+    add_query_job_columns,
+    add_keys_and_indexes,
+    add_query_blob_hash,
+    add_pregenerated_table,
+]
+
+
+def get_version(conn):
+    '''
+    Get the schema version of a database, or None if it is empty
+    '''
+    tables = inspect(conn).get_table_names()
+    if "schema_version" in tables:
+        return conn.execute(text("SELECT version FROM schema_version")).scalar()
+    return 0 if "users" in tables else None
+
+
+def set_version(conn, version):
+    '''
+    Record the schema version of a database
+    '''
+    conn.execute(text("DELETE FROM schema_version"))
+    conn.execute(text("INSERT INTO schema_version (version) VALUES (:version)"),
+                 {"version": version})
+
+
+def upgrade(db):
+    '''
+    Bring the database behind db up to the latest schema
+    '''
+    # Nothing to write, so app processes starting together do not
+    # contend for the database lock
+    with db.engine.connect() as conn:
+        if get_version(conn) == len(MIGRATIONS):
+            return
+    with db.engine.begin() as conn:
+        if conn.dialect.name == "sqlite":
+            # pysqlite commits DDL as it goes, a failed migration would
+            # leave a half upgraded database stamped with no version
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        # Another process may have upgraded while this one waited
+        version = get_version(conn)
+        if version == len(MIGRATIONS):
+            return
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+        if version is None:
+            db.metadata.create_all(conn)
+        else:
+            for migration in MIGRATIONS[version:]:
+                migration(conn)
+            # Tables added since the database was created
+            db.metadata.create_all(conn)
+        set_version(conn, len(MIGRATIONS))
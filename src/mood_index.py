@@ -0,0 +1,171 @@
+import math
+import threading
+from db import db
+from db import Song, association_table8
+import moods
+
+
+class MoodIndex:
+    '''
+    In-memory spatial index of songs by mood vector. Songs are grouped by
+    their exact point in mood space (most share one of the 144 grid
+    points) and points are bucketed into unit grid cells, so a k nearest
+    neighbours query only looks at the few cells around the target.
+    '''
+
+    def __init__(self):
+        '''
+        Initialize an empty MoodIndex
+        '''
+        self.lock = threading.RLock()
+        # cell -> point -> bucket (None for every song, or a genre id) ->
+        # song ids, kept as dicts so they stay in insertion order
+        self.cells = {}
+        # song id -> (point, genre ids)
+        self.songs = {}
+
+    def add(self, song_id, mood, genre_ids=()):
+        '''
+        Add or update a song, songs without a known mood are not indexed
+        '''
+        vector = moods.mood_vector(mood)
+        with self.lock:
+            self.remove(song_id)
+            if vector is None:
+                return
+            point = (float(vector[0]), float(vector[1]))
+            buckets = self.cells.setdefault(cell_of(point), {}).setdefault(point, {})
+            for bucket in (None, *genre_ids):
+                buckets.setdefault(bucket, {})[song_id] = None
+            self.songs[song_id] = (point, frozenset(genre_ids))
+
+    def remove(self, song_id):
+        '''
+        Remove a song from the index if it is in it
+        '''
+        with self.lock:
+            entry = self.songs.pop(song_id, None)
+            if entry is None:
+                return
+            point, genre_ids = entry
+            points = self.cells[cell_of(point)]
+            for bucket in (None, *genre_ids):
+                del points[point][bucket][song_id]
+                if not points[point][bucket]:
+                    del points[point][bucket]
+            if not points[point]:
+                del points[point]
+                if not points:
+                    del self.cells[cell_of(point)]
+
+    def remove_genre(self, genre_id):
+        '''
+        Drop a deleted genre from every song
+        '''
+        with self.lock:
+            for points in self.cells.values():
+                for buckets in points.values():
+                    buckets.pop(genre_id, None)
+            for song_id, (point, genre_ids) in self.songs.items():
+                if genre_id in genre_ids:
+                    self.songs[song_id] = (point, genre_ids - {genre_id})
+
+    def vector(self, song_id):
+        '''
+        Get the indexed mood vector of a song
+        '''
+        entry = self.songs.get(song_id)
+        return None if entry is None else entry[0]
+
+    def nearest(self, x, y, k=10, genre_id=None, exclude=None):
+        '''
+        Get the ids of the k songs nearest to (x, y), nearest first,
+        optionally only songs in genre_id
+        '''
+        with self.lock:
+            if not self.cells or k <= 0:
+                return []
+            cx, cy = math.floor(x), math.floor(y)
+            radius = max(max(abs(cell_x - cx), abs(cell_y - cy))
+                         for cell_x, cell_y in self.cells)
+            found = []
+            for ring in range(radius + 1):
+                for cell in ring_cells(cx, cy, ring):
+                    for point, buckets in self.cells.get(cell, {}).items():
+                        songs = buckets.get(genre_id)
+                        if songs:
+                            found.append((math.dist((x, y), point), songs))
+                # Anything beyond this ring is at least `ring` away, so we
+                # are done once k songs are at most that far
+                close = sum(len(songs) - (exclude in songs)
+                            for distance, songs in found if distance <= ring)
+                if close >= k:
+                    break
+            found.sort(key=lambda entry: entry[0])
+            result = []
+            for distance, songs in found:
+                for song_id in songs:
+                    if song_id != exclude:
+                        result.append(song_id)
+                        if len(result) == k:
+                            return result
+            return result
+
+
+def load(index):
+    '''
+    Fill an index with every song in the database
+    '''
+    genre_ids = {}
+    for song_id, genre_id in db.session.query(
+            association_table8.c.song_id, association_table8.c.genre_id):
+        genre_ids.setdefault(song_id, []).append(genre_id)
+    for song_id, mood in db.session.query(Song.id, Song.mood).filter(Song.mood != ''):
+        index.add(song_id, mood, genre_ids.get(song_id, ()))
+    return index
+
+
+def cell_of(point):
+    '''
+    Get the unit grid cell a point falls in
+    '''
+    return (math.floor(point[0]), math.floor(point[1]))
+
+
+def ring_cells(cx, cy, ring):
+    '''
+    Get the grid cells at Chebyshev distance ring from (cx, cy)
+    '''
+    if ring == 0:
+        return [(cx, cy)]
+    cells = []
+    for dx in range(-ring, ring + 1):
+        cells.append((cx + dx, cy - ring))
+        cells.append((cx + dx, cy + ring))
+    for dy in range(-ring + 1, ring):
+        cells.append((cx - ring, cy + dy))
+        cells.append((cx + ring, cy + dy))
+    return cells
+
+
+if __name__ == "__main__":
+    # k-NN latency with 1M songs indexed
+    import random
+    import time
+
+    index = MoodIndex()
+    words = list(moods.LEXICON)
+    for song_id in range(1000000):
+        index.add(song_id, random.choice(words), [random.randint(1, 20)])
+    queries = 1000
+    start = time.perf_counter()
+    for _ in range(queries):
+        index.nearest(random.uniform(-6, 6), random.uniform(-6, 6), k=10)
+    print("k-NN:         %.3f ms" % (
+        (time.perf_counter() - start) / queries * 1000))
+    start = time.perf_counter()
+    for _ in range(queries):
+        index.nearest(random.uniform(-6, 6), random.uniform(-6, 6), k=10,
+                      genre_id=random.randint(1, 20))
+    print("k-NN (genre): %.3f ms" % (
+        (time.perf_counter() - start) / queries * 1000))
@@ -0,0 +1,174 @@
+import math
+import re
+from array import array
+from itertools import islice
+
+# Parser for the melodies the LLM writes, e.g.
+#   [{'note': 60, 'start_time': 0.0, 'duration': 0.5, 'velocity': 100}, ...]
+# Only the note dicts themselves are read, so JSON quoting, code fences,
+# trailing commas and surrounding chatter are all accepted, and a final
+# entry cut off by the token limit is dropped instead of failing the song.
+
+OBJECT = re.compile(r"\{([^{}]*)\}")
+FIELD = re.compile(
+    r"""["']?(note|start_time|duration|velocity)["']?\s*:\s*"""
+    r"""(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)""")
+# Latest beat a note may end on, 10 minutes at the renderer's 120 BPM. The
+# synth allocates audio up to the last note, so one absurd time from a bad
+# completion would otherwise cost gigabytes.
+max_beats = 1200
+
+
+class NoteParseError(Exception):
+    '''
+    Raised when no valid notes could be read from a melody
+    '''
+
+
+class NoteArray:
+    '''
+    Compact column-oriented storage of notes
+    '''
+
+    def __init__(self):
+        '''
+        Initialize an empty NoteArray
+        '''
+        self.notes = array("B")
+        self.velocities = array("B")
+        self.start_times = array("d")
+        self.durations = array("d")
+
+    def append(self, note, start_time, duration, velocity):
+        '''
+        Add a note to the array
+        '''
+        self.notes.append(note)
+        self.start_times.append(start_time)
+        self.durations.append(duration)
+        self.velocities.append(velocity)
+
+    def __len__(self):
+        return len(self.notes)
+
+    def __iter__(self):
+        '''
+        Iterate over (note, start_time, duration, velocity) tuples
+        '''
+        return zip(self.notes, self.start_times, self.durations, self.velocities)
+
+    def serialize(self, start=0):
+        '''
+        Serialize the notes from index start on to the list of dicts format
+        '''
+        return [
+            {'note': note, 'start_time': start_time,
+             'duration': duration, 'velocity': velocity}
+            for note, start_time, duration, velocity in islice(self, start, None)
+        ]
+
+
+class NoteParser:
+    '''
+    Incremental parser, feed() it chunks of a melody as they arrive
+    '''
+
+    def __init__(self):
+        '''
+        Initialize a NoteParser
+        '''
+        self.buffer = ""
+        self.result = NoteArray()
+        self.errors = []
+
+    def feed(self, chunk):
+        '''
+        Parse a chunk of text, returning the number of new notes read
+        '''
+        self.buffer += chunk
+        end = self.buffer.rfind("}")
+        if end == -1:
+            return 0
+        count = self.parse_objects(self.buffer[:end + 1])
+        self.buffer = self.buffer[end + 1:]
+        return count
+
+    def close(self):
+        '''
+        Finish parsing and return the notes read. Anything left in the
+        buffer is an unterminated entry and is dropped.
+        '''
+        if "{" in self.buffer:
+            self.errors.append("dropped truncated final note")
+        self.buffer = ""
+        if len(self.result) == 0:
+            raise NoteParseError(
+                "no valid notes in melody: %s" % "; ".join(self.errors))
+        return self.result
+
+    def parse_objects(self, text):
+        '''
+        Parse every complete note dict in text
+        '''
+        count = 0
+        for match in OBJECT.finditer(text):
+            fields = dict(FIELD.findall(match.group(1)))
+            error = self.parse_note(fields)
+            if error is None:
+                count += 1
+            else:
+                self.errors.append("%s in %s" % (error, match.group(0)))
+        return count
+
+    def parse_note(self, fields):
+        '''
+        Validate one note's fields and add it, returning an error message
+        if it is invalid
+        '''
+        try:
+            note, start_time, duration, velocity = [float(fields[name]) for name in (
+                "note", "start_time", "duration", "velocity")]
+        except KeyError as e:
+            return "missing %s" % e
+        # Exponents like 1e400 parse to inf, which int() cannot convert
+        if not all(map(math.isfinite, (note, start_time, duration, velocity))):
+            return "non-finite value"
+        note = int(note)
+        velocity = int(velocity)
+        if not 0 <= note <= 127:
+            return "note out of range"
+        if not 0 <= velocity <= 127:
+            return "velocity out of range"
+        if start_time < 0 or duration < 0:
+            return "negative time"
+        if start_time + duration > max_beats:
+            return "note ends after beat %d" % max_beats
+        self.result.append(note, start_time, duration, velocity)
+        return None
+
+
+def parse(text):
+    '''
+    Parse a complete melody into a NoteArray
+    '''
+    parser = NoteParser()
+    parser.feed(text)
+    return parser.close()
+
+
+if __name__ == "__main__":
+    # Micro-benchmark against the old eval() path on a 10k note melody
+    import random
+    import timeit
+
+    melody = "```python\n[\n" + ",\n".join(
+        "{'note': %d, 'start_time': %.1f, 'duration': 0.5, 'velocity': %d}" % (
+            random.randint(0, 127), i * 0.5, random.randint(0, 127))
+        for i in range(10000)
+    ) + "\n]\n```"
+    bare = melody.strip("`\npython")
+    runs = 20
+    eval_time = timeit.timeit(lambda: eval(bare.strip()), number=runs) / runs
+    parse_time = timeit.timeit(lambda: parse(melody), number=runs) / runs
+    print("eval:  %.2f ms" % (eval_time * 1000))
+    print("parse: %.2f ms" % (parse_time * 1000))
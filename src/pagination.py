@@ -0,0 +1,119 @@
+import base64
+import binascii
+from sqlalchemy.orm import lazyload
+from db import Genre
+
+default_limit = 50
+max_limit = 10000
+# Pages bigger than this are streamed out row by row
+stream_limit = 500
+
+
+class PaginationError(Exception):
+    '''
+    Raised for malformed pagination, projection or filter parameters
+    '''
+
+
+def encode_cursor(last_id):
+    '''
+    Encode the id of the last row of a page into an opaque cursor
+    '''
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode()
+
+
+def decode_cursor(cursor):
+    '''
+    Decode a cursor back into the id of the last row already returned
+    '''
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        raise PaginationError("Invalid cursor")
+
+
+def int_arg(args, name, default=None):
+    '''
+    Read an integer query string argument
+    '''
+    value = args.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise PaginationError("%s must be an integer" % name)
+
+
+def filter_genre(query, model, args):
+    '''
+    Push genre_id= and genre= filters on a model's genres into SQL
+    '''
+    genre_id = int_arg(args, 'genre_id')
+    if genre_id is not None:
+        query = query.filter(model.genres.any(Genre.id == genre_id))
+    if args.get('genre') is not None:
+        query = query.filter(model.genres.any(Genre.genre == args['genre']))
+    return query
+
+
+def project(row, expand, fields):
+    '''
+    Serialize a row in the full or simple shape, keeping only fields
+    '''
+    if expand or not hasattr(row, 'simple_serialize'):
+        data = row.serialize()
+    else:
+        data = row.simple_serialize()
+    if fields:
+        data = {key: value for key, value in data.items() if key in fields}
+    return data
+
+
+def paginate(query, model, args, key):
+    '''
+    Get one page of a query using keyset pagination on the primary key.
+    Understands limit=, cursor=, expand= (false for the simple shape
+    without relationships) and fields= (comma separated keys to keep).
+    '''
+    limit = int_arg(args, 'limit', default_limit)
+    if not 1 <= limit <= max_limit:
+        raise PaginationError("limit must be between 1 and %d" % max_limit)
+    if args.get('cursor'):
+        query = query.filter(model.id > decode_cursor(args['cursor']))
+    expand = args.get('expand', 'true').lower() not in ('false', '0', 'no')
+    if not expand:
+        # The simple shape never touches relationships, skip loading them
+        query = query.options(lazyload('*'))
+    fields = set(args['fields'].split(',')) if args.get('fields') else None
+
+    query = query.order_by(model.id).limit(limit + 1)
+    if limit > stream_limit:
+        return stream(query, limit, expand, fields, key)
+    rows = query.all()
+    next_cursor = encode_cursor(rows[limit - 1].id) if len(rows) > limit else None
+    return {
+        key: [project(row, expand, fields) for row in rows[:limit]],
+        'next_cursor': next_cursor,
+    }
+
+
+def stream(query, limit, expand, fields, key):
+    '''
+    Get a page whose rows are loaded and serialized in chunks while the
+    response is written, the cursor is only known once they all are
+    '''
+    state = {'last_id': None, 'more': False}
+
+    def rows():
+        for i, row in enumerate(query.yield_per(stream_limit)):
+            if i == limit:
+                state['more'] = True
+                break
+            state['last_id'] = row.id
+            yield project(row, expand, fields)
+
+    def next_cursor():
+        return encode_cursor(state['last_id']) if state['more'] else None
+
+    return {key: rows(), 'next_cursor': next_cursor}
@@ -1,24 +1,245 @@
-# API key
-# 962fa8b11eaf3c7494cb
+import hashlib
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
 
-# API secret
-# 5ef5a385c5945dfe8dca29087df17ccb7527e9e64350e8da72f7b04226fbea2a
+# Tunables for the upload client
+max_concurrent = int(os.environ.get("PINATA_MAX_CONCURRENT", 4))
+max_attempts = int(os.environ.get("PINATA_MAX_ATTEMPTS", 4))
+backoff_base = float(os.environ.get("PINATA_BACKOFF_BASE", 0.5))
+backoff_cap = float(os.environ.get("PINATA_BACKOFF_CAP", 8))
+timeout = (float(os.environ.get("PINATA_CONNECT_TIMEOUT", 10)),
+           float(os.environ.get("PINATA_READ_TIMEOUT", 120)))
 
-# JWT
-# eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.eyJ1c2VySW5mb3JtYXRpb24iOnsiaWQiOiIzZGFiYzcxMi1iYTliLTQxN2QtYWY3ZC01MDU3YzcwYTI1ODkiLCJlbWFpbCI6Impvc2hkaXJnYUBnbWFpbC5jb20iLCJlbWFpbF92ZXJpZmllZCI6dHJ1ZSwicGluX3BvbGljeSI6eyJyZWdpb25zIjpbeyJkZXNpcmVkUmVwbGljYXRpb25Db3VudCI6MSwiaWQiOiJGUkExIn0seyJkZXNpcmVkUmVwbGljYXRpb25Db3VudCI6MSwiaWQiOiJOWUMxIn1dLCJ2ZXJzaW9uIjoxfSwibWZhX2VuYWJsZWQiOmZhbHNlLCJzdGF0dXMiOiJBQ1RJVkUifSwiYXV0aGVudGljYXRpb25UeXBlIjoic2NvcGVkS2V5Iiwic2NvcGVkS2V5S2V5IjoiOTYyZmE4YjExZWFmM2M3NDk0Y2IiLCJzY29wZWRLZXlTZWNyZXQiOiI1ZWY1YTM4NWM1OTQ1ZGZlOGRjYTI5MDg3ZGYxN2NjYjc1MjdlOWU2NDM1MGU4ZGE3MmY3YjA0MjI2ZmJlYTJhIiwiZXhwIjoxNzU5NzE2Njc2fQ.4F0ZHtVBNCLr7vN83YURKlHd-sNmX1_b9ce0ieLmrxc
 
-import requests
+class UploadError(Exception):
+    '''
+    Raised when a backend rejects an upload or it keeps failing
+    '''
 
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
 
-def upload_pinata(filepath):
-    url = "https://api.pinata.cloud/pinning/pinFileToIPFS"
-    jwt = "eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.eyJ1c2VySW5mb3JtYXRpb24iOnsiaWQiOiIzZGFiYzcxMi1iYTliLTQxN2QtYWY3ZC01MDU3YzcwYTI1ODkiLCJlbWFpbCI6Impvc2hkaXJnYUBnbWFpbC5jb20iLCJlbWFpbF92ZXJpZmllZCI6dHJ1ZSwicGluX3BvbGljeSI6eyJyZWdpb25zIjpbeyJkZXNpcmVkUmVwbGljYXRpb25Db3VudCI6MSwiaWQiOiJGUkExIn0seyJkZXNpcmVkUmVwbGljYXRpb25Db3VudCI6MSwiaWQiOiJOWUMxIn1dLCJ2ZXJzaW9uIjoxfSwibWZhX2VuYWJsZWQiOmZhbHNlLCJzdGF0dXMiOiJBQ1RJVkUifSwiYXV0aGVudGljYXRpb25UeXBlIjoic2NvcGVkS2V5Iiwic2NvcGVkS2V5S2V5IjoiOTYyZmE4YjExZWFmM2M3NDk0Y2IiLCJzY29wZWRLZXlTZWNyZXQiOiI1ZWY1YTM4NWM1OTQ1ZGZlOGRjYTI5MDg3ZGYxN2NjYjc1MjdlOWU2NDM1MGU4ZGE3MmY3YjA0MjI2ZmJlYTJhIiwiZXhwIjoxNzU5NzE2Njc2fQ.4F0ZHtVBNCLr7vN83YURKlHd-sNmX1_b9ce0ieLmrxc"
-    headers = {'Authorization': f'Bearer {jwt}'}
 
-    with open(filepath, 'rb') as file:
-        response = requests.post(url, files={'file': file}, headers=headers)
+def multipart(chunks, file_name, content_type, field="file"):
+    '''
+    Wrap chunks in a multipart/form-data body without buffering them,
+    returning the body iterator and its content type
+    '''
+    boundary = uuid.uuid4().hex
+
+    def body():
+        yield (f'--{boundary}\r\n'
+               f'Content-Disposition: form-data; name="{field}"; filename="{file_name}"\r\n'
+               f'Content-Type: {content_type}\r\n\r\n').encode()
+        yield from chunks
+        yield f'\r\n--{boundary}--\r\n'.encode()
+
+    return body(), f'multipart/form-data; boundary={boundary}'
+
+
+class PinataBackend:
+    '''
+    Pins files with the Pinata API, or any server speaking it
+    '''
+
+    def __init__(self, session, url="https://api.pinata.cloud/pinning/pinFileToIPFS", jwt=None):
+        self.session = session
+        self.url = url
+        self.headers = {'Authorization': f'Bearer {jwt}'}
+
+    def pin(self, chunks, file_name, content_type):
+        body, body_type = multipart(chunks, file_name, content_type)
+        response = self.session.post(self.url, data=body, timeout=timeout, headers={
+            **self.headers, 'Content-Type': body_type})
+        check(response)
         return response.json()['IpfsHash']
 
+
+class IpfsBackend:
+    '''
+    Adds files to an IPFS node through its HTTP RPC API
+    '''
+
+    def __init__(self, session, url="http://127.0.0.1:5001/api/v0/add"):
+        self.session = session
+        self.url = url
+
+    def pin(self, chunks, file_name, content_type):
+        body, body_type = multipart(chunks, file_name, content_type)
+        response = self.session.post(
+            self.url, params={'pin': 'true', 'cid-version': 1}, data=body,
+            timeout=timeout, headers={'Content-Type': body_type})
+        check(response)
+        return response.json()['Hash']
+
+
+def check(response):
+    '''
+    Raise an UploadError for a failed response, 429s and 5xxs can be retried
+    '''
+    if response.status_code >= 400:
+        raise UploadError(
+            "upload failed with %d: %s" % (response.status_code, response.text[:200]),
+            retryable=response.status_code == 429 or response.status_code >= 500)
+
+
+class Uploader:
+    '''
+    Upload client running at most max_concurrent uploads at once over a
+    pooled session, retrying transient failures with jittered backoff and
+    reusing the CID of content it has already uploaded
+    '''
+
+    def __init__(self, backend, max_concurrent=max_concurrent, known_cids=100000):
+        '''
+        Initialize an Uploader for a backend
+        '''
+        self.backend = backend
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_concurrent, thread_name_prefix="upload")
+        self.known_cids = known_cids
+        self.cids = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"uploads": 0, "deduplicated": 0, "retries": 0,
+                         "failures": 0, "bytes": 0}
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def upload(self, open_chunks, file_name, content_type, content_hash=None):
+        '''
+        Upload a file and return its CID. open_chunks returns a fresh
+        iterable of the file's bytes on every call so the upload can be
+        retried. When content_hash is given and was uploaded before, the
+        known CID is returned without any network call.
+        '''
+        if content_hash is not None:
+            with self.lock:
+                cid = self.cids.get(content_hash)
+                if cid is not None:
+                    self.cids.move_to_end(content_hash)
+                    self.counters["deduplicated"] += 1
+                    return cid
+        for attempt in range(max_attempts):
+            try:
+                with self.slots:
+                    cid = self.backend.pin(
+                        self.measure(open_chunks()), file_name, content_type)
+                break
+            except (requests.ConnectionError, requests.Timeout, UploadError) as e:
+                retryable = getattr(e, "retryable", True)
+                if not retryable or attempt == max_attempts - 1:
+                    self.count("failures")
+                    raise
+                self.count("retries")
+                time.sleep(random.uniform(
+                    0, min(backoff_cap, backoff_base * 2 ** attempt)))
+        self.count("uploads")
+        if content_hash is not None:
+            with self.lock:
+                self.cids[content_hash] = cid
+                while len(self.cids) > self.known_cids:
+                    self.cids.popitem(last=False)
+        return cid
+
+    def measure(self, chunks):
+        for chunk in chunks:
+            self.count("bytes", len(chunk))
+            yield chunk
+
+    def upload_bytes(self, data, file_name, content_type="application/octet-stream"):
+        '''
+        Upload bytes, deduplicated on their sha256
+        '''
+        return self.upload(lambda: [data], file_name, content_type,
+                           hashlib.sha256(data).hexdigest())
+
+    def upload_many(self, files):
+        '''
+        Upload (data, file_name, content_type) tuples concurrently and
+        return their CIDs in the same order
+        '''
+        return list(self.executor.map(
+            lambda file: self.upload_bytes(*file), files))
+
+    def stats(self):
+        '''
+        Get the upload counters
+        '''
+        with self.lock:
+            return {**self.counters, "known_cids": len(self.cids)}
+
+
+def backend_from_env():
+    '''
+    Pick the upload backend from the environment: IPFS_API_URL for an IPFS
+    node, otherwise Pinata at PINATA_URL (handy for a local stand-in) with
+    the PINATA_JWT key
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrent)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if os.environ.get("IPFS_API_URL"):
+        return IpfsBackend(session, os.environ["IPFS_API_URL"])
+    if not os.environ.get("PINATA_JWT"):
+        raise RuntimeError("Set PINATA_JWT to upload to Pinata, or IPFS_API_URL "
+                           "to use an IPFS node")
+    return PinataBackend(
+        session,
+        os.environ.get("PINATA_URL", "https://api.pinata.cloud/pinning/pinFileToIPFS"),
+        os.environ["PINATA_JWT"])
+
+
+uploader = Uploader(backend_from_env())
+
+
+def upload_pinata(filepath):
+    with open(filepath, 'rb') as file:
+        return upload_pinata_bytes(file.read(), os.path.basename(filepath))
+
+
+def upload_pinata_bytes(data, file_name):
+    return uploader.upload_bytes(data, file_name)
+
+
+def upload_pinata_stream(open_chunks, file_name, content_type, content_hash=None):
+    return uploader.upload(open_chunks, file_name, content_type, content_hash)
+
+if __name__ == "__main__":
+    # Upload throughput against the local stand-in, then the same files
+    # again to show deduplication
+    #   PINATA_JWT=fake python3 pinata_integration.py
+    import fake_pinata
+
+    server = fake_pinata.serve(latency=float(os.environ.get("BENCH_LATENCY", 0.1)))
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_maxsize=max_concurrent))
+    bench = Uploader(PinataBackend(
+        session, "http://%s:%d/pinning/pinFileToIPFS" % server.server_address, "fake"))
+    files = [(os.urandom(1 << 20), "song%d.wav" % i, "audio/wav")
+             for i in range(int(os.environ.get("BENCH_FILES", 50)))]
+    for label in ("fresh", "duplicate"):
+        sent = bench.stats()["bytes"]
+        start = time.perf_counter()
+        bench.upload_many(files)
+        elapsed = time.perf_counter() - start
+        # Deduplicated uploads send nothing
+        print("%-9s %6.1f uploads/s %7.1f MB/s sent" % (
+            label, len(files) / elapsed,
+            (bench.stats()["bytes"] - sent) / elapsed / (1 << 20)))
+    print(bench.stats())
+
 # print(upload_pinata("Bounce.mid"))
 
 # To get link to file
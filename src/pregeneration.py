@@ -0,0 +1,155 @@
+import re
+import threading
+import time
+from sqlalchemy import desc, func
+from db import db
+from db import Genre, Pregenerated, Query
+from db import association_table5
+import gpt4_querier
+
+# Prompts that say nothing beyond the mood and genre, a query with one of
+# these (or none) can be given a pre-generated song
+GENERIC_PROMPTS = {
+    "", "a song", "any", "anything", "music", "some music", "random",
+    "something", "song", "surprise me", "whatever",
+}
+PUNCTUATION = re.compile(r"[^\w\s]")
+
+
+def normalize_mood(mood):
+    return (mood or "").strip().lower()
+
+
+def is_generic(text):
+    '''
+    Whether a query prompt asks for nothing in particular
+    '''
+    return PUNCTUATION.sub("", text or "").strip().lower() in GENERIC_PROMPTS
+
+
+class Pregenerator:
+    '''
+    Keeps a pool of unused songs for the most requested (mood, genre)
+    pairs, rendered and stored through the job queue, so that generic
+    queries can be answered right away
+    '''
+
+    def __init__(self, app, job_queue, pairs=50, variants=4,
+                 output_format="wav", duration=10):
+        '''
+        Initialize a Pregenerator keeping `variants` unused songs for each
+        of the `pairs` most requested pairs
+        '''
+        self.app = app
+        self.job_queue = job_queue
+        self.pairs = pairs
+        self.variants = variants
+        self.output_format = output_format
+        self.duration = duration
+        self.lock = threading.Lock()
+        self.served = 0
+
+    def popular_pairs(self):
+        '''
+        Get the most requested (mood, genre id) pairs, the genre id being
+        None for queries without a genre
+        '''
+        mood = func.lower(func.trim(Query.mood)).label("mood")
+        count = func.count(Query.id).label("count")
+        return db.session.query(mood, association_table5.c.genre_id, count) \
+            .outerjoin(association_table5, association_table5.c.query_id == Query.id) \
+            .filter(Query.mood != '') \
+            .group_by(mood, association_table5.c.genre_id) \
+            .order_by(desc(count)) \
+            .limit(self.pairs).all()
+
+    def refill(self):
+        '''
+        Top up the pool of every popular pair, returning the number of
+        songs made
+        '''
+        unused = dict(
+            ((mood, genre_id), count) for mood, genre_id, count in
+            db.session.query(Pregenerated.mood, Pregenerated.genre_id,
+                             func.count(Pregenerated.id))
+            .filter_by(used=False, output_format=self.output_format,
+                       duration=self.duration)
+            .group_by(Pregenerated.mood, Pregenerated.genre_id))
+        genres = {genre.id: genre.genre for genre in Genre.query}
+        created = 0
+        for mood, genre_id, requested in self.popular_pairs():
+            missing = self.variants - unused.get((mood, genre_id), 0)
+            if missing > 0:
+                created += self.generate(mood, genre_id, genres.get(genre_id), missing)
+        return created
+
+    def generate(self, mood, genre_id, genre, count):
+        '''
+        Make `count` songs for a pair, returning how many came out valid
+        '''
+        variants = gpt4_querier.generate_variants(
+            mood, [genre] if genre else [], self.duration, count)
+        created = 0
+        for melody, title in variants:
+            try:
+                blob_hash = self.job_queue.produce(melody, self.output_format)
+            except Exception:
+                continue
+            db.session.add(Pregenerated(
+                mood=mood, genre_id=genre_id, duration=self.duration,
+                output_format=self.output_format, title=title,
+                blob_hash=blob_hash))
+            created += 1
+        db.session.commit()
+        return created
+
+    def claim(self, mood, genre_id, output_format, duration):
+        '''
+        Mark an unused song of a pair as used and return it, or None if
+        there is none. The caller commits.
+        '''
+        candidates = Pregenerated.query.filter_by(
+            mood=normalize_mood(mood), genre_id=genre_id, output_format=output_format,
+            duration=duration, used=False).order_by(Pregenerated.id).limit(5).all()
+        for variant in candidates:
+            # Only one concurrent request can flip the flag, variants
+            # evicted from the blob store before anyone asked for them
+            # are flipped too so that refill replaces them
+            available = self.job_queue.store.open(variant.blob_hash) is not None
+            claimed = Pregenerated.query.filter_by(id=variant.id, used=False) \
+                .update({"used": True}, synchronize_session=False)
+            if not claimed or not available:
+                continue
+            with self.lock:
+                self.served += 1
+            return variant
+        return None
+
+    def start(self, interval):
+        '''
+        Refill the pool every interval seconds on a background thread
+        '''
+        def work():
+            while True:
+                time.sleep(interval)
+                try:
+                    with self.app.app_context():
+                        self.refill()
+                except Exception:
+                    pass
+        threading.Thread(target=work, name="pregenerator", daemon=True).start()
+
+    def stats(self):
+        '''
+        Get the size of the pool and how many songs it served
+        '''
+        unused = Pregenerated.query.filter_by(used=False).count()
+        with self.lock:
+            served = self.served
+        return {
+            "unused": unused,
+            "used": Pregenerated.query.filter_by(used=True).count(),
+            "served": served,
+            "pairs": self.pairs,
+            "variants": self.variants,
+        }
@@ -0,0 +1,207 @@
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from midiutil import MIDIFile
+from midi2audio import FluidSynth
+import config
+import note_parser
+
+try:
+    import fluidsynth
+except ImportError:
+    fluidsynth = None
+
+sound_font = os.environ.get(
+    "NOCTURNE_SOUNDFONT",
+    os.path.expanduser("~/.fluidsynth/default_sound_font.sf2"))
+sample_rate = 44100
+tempo = 120  # Tempo in BPM (beats per minute)
+release = 1.0  # Seconds rendered after the last note ends
+# Stand-in for FluidSynth rendering silence of the right length, for
+# benchmarks on machines without a synth or soundfont
+fake_synth = config.env_flag("NOCTURNE_FAKE_SYNTH")
+
+# Per-process synth, loaded once by init_worker()
+synth = None
+
+
+def build_midi(notes):
+    '''
+    Build a single track MIDI file from notes and return its bytes
+    '''
+    # Create a new MIDI file with 1 track
+    MyMIDI = MIDIFile(1)
+
+    # General parameters for the MIDI file
+    track = 0  # Track number
+    channel = 0  # MIDI channel (0-15, where 0 is usually the default)
+    # Add tempo to the track starting at time 0
+    MyMIDI.addTempo(track, 0, tempo)
+
+    # note: MIDI note number (e.g., 60 for C4), start_time and duration in
+    # beats, velocity is the volume/intensity of the note
+    for note, start_time, duration, velocity in notes:
+        # Add the note to the MIDI file
+        MyMIDI.addNote(track, channel, note, start_time, duration, velocity)
+
+    output = io.BytesIO()
+    MyMIDI.writeFile(output)
+    return output.getvalue()
+
+
+def init_worker(font):
+    '''
+    Load the soundfont once in a renderer process
+    '''
+    global synth
+    if fake_synth:
+        return
+    if fluidsynth is not None:
+        synth = fluidsynth.Synth(samplerate=float(sample_rate))
+        synth.program_select(0, synth.sfload(font), 0, 0)
+    else:
+        synth = FluidSynth(font, sample_rate)
+
+
+def render_notes(notes):
+    '''
+    Render notes to WAV bytes in a renderer process
+    '''
+    if fake_synth:
+        return render_silence(notes)
+    if fluidsynth is None:
+        return render_with_cli(notes)
+    seconds_per_beat = 60.0 / tempo
+    events = []
+    for note, start_time, duration, velocity in notes:
+        events.append((start_time * seconds_per_beat, 1, note, velocity))
+        events.append(((start_time + duration) * seconds_per_beat, 0, note, 0))
+    # Note offs sort before note ons at the same instant
+    events.sort()
+
+    chunks = []
+    cursor = 0
+    for time, on, note, velocity in events:
+        frames = int(time * sample_rate) - cursor
+        if frames > 0:
+            chunks.append(fluidsynth.raw_audio_string(
+                synth.get_samples(frames)))
+            cursor += frames
+        if on:
+            synth.noteon(0, note, velocity)
+        else:
+            synth.noteoff(0, note)
+    chunks.append(fluidsynth.raw_audio_string(
+        synth.get_samples(int(release * sample_rate))))
+
+    output = io.BytesIO()
+    with wave.open(output, "wb") as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(b"".join(chunks))
+    return output.getvalue()
+
+
+def render_silence(notes):
+    '''
+    Render as much silence as the notes would last
+    '''
+    seconds_per_beat = 60.0 / tempo
+    end = max((start_time + duration for note, start_time, duration, velocity
+               in notes), default=0.0)
+    frames = int((end * seconds_per_beat + release) * sample_rate)
+    output = io.BytesIO()
+    with wave.open(output, "wb") as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(bytes(frames * 4))
+    return output.getvalue()
+
+
+def render_with_cli(notes):
+    '''
+    Render notes through the fluidsynth binary when pyfluidsynth is not
+    installed, using a private scratch directory per render
+    '''
+    with tempfile.TemporaryDirectory(prefix="nocturne-") as scratch:
+        midi_file = os.path.join(scratch, "song.mid")
+        wav_file = os.path.join(scratch, "song.wav")
+        with open(midi_file, "wb") as output_file:
+            output_file.write(build_midi(notes))
+        synth.midi_to_audio(midi_file, wav_file)
+        with open(wav_file, "rb") as input_file:
+            return input_file.read()
+
+
+class RendererPool:
+    '''
+    Pool of warm synth processes rendering notes to in-memory audio
+    '''
+
+    def __init__(self, workers=2, font=sound_font):
+        '''
+        Initialize a RendererPool, at most `workers` renders run at once
+        '''
+        self.workers = workers
+        self.font = font
+        self.lock = threading.Lock()
+        self.executor = self.start()
+        self.outstanding = 0
+        self.rendered = 0
+        self.restarts = 0
+
+    def start(self):
+        '''
+        Create the executor. Its processes are started lazily, after the
+        job and pinner threads, so they come from a forkserver instead of
+        being forked from a multi-threaded process.
+        '''
+        return ProcessPoolExecutor(
+            max_workers=self.workers, initializer=init_worker, initargs=(self.font,),
+            mp_context=multiprocessing.get_context("forkserver"))
+
+    def render(self, notes):
+        '''
+        Render notes (a NoteArray or raw LLM output) to WAV bytes
+        '''
+        if not isinstance(notes, note_parser.NoteArray):
+            notes = note_parser.parse(notes)
+        with self.lock:
+            self.outstanding += 1
+            executor = self.executor
+        try:
+            return executor.submit(render_notes, notes).result()
+        except BrokenProcessPool:
+            # A synth process died (segfault, OOM) and took the executor
+            # down with it, the renders in flight fail but later ones get
+            # a fresh executor
+            with self.lock:
+                if self.executor is executor:
+                    self.executor = self.start()
+                    self.restarts += 1
+            executor.shutdown(wait=False)
+            raise
+        finally:
+            with self.lock:
+                self.outstanding -= 1
+                self.rendered += 1
+
+    def stats(self):
+        '''
+        Get the queue depth and throughput counters of the pool
+        '''
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "in_flight": min(self.outstanding, self.workers),
+                "queue_depth": max(0, self.outstanding - self.workers),
+                "rendered": self.rendered,
+                "restarts": self.restarts,
+            }
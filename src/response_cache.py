@@ -0,0 +1,188 @@
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from flask import make_response, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from db import User, Genre, Query, Song
+
+
+def resources_of(row):
+    '''
+    Get the cached resources whose payload includes a changed row
+    '''
+    if isinstance(row, User):
+        return ["users", "user:%s" % row.id]
+    if isinstance(row, Song):
+        return ["songs", "song:%s" % row.id, "users", "user:%s" % row.user_id]
+    if isinstance(row, Query):
+        return ["queries", "query:%s" % row.id, "users", "user:%s" % row.user_id]
+    return []
+
+
+class ResponseCache:
+    '''
+    LRU cache of serialized GET responses. Every resource ("songs",
+    "song:5", ...) has a version that is bumped when a commit in this
+    process changes a row it includes, cached payloads are keyed by
+    resource and version so a bump makes them unreachable. Writes from
+    other processes (scripts sharing the database) cannot bump
+    it, so payloads also expire after ttl seconds. The ETag is a hash of
+    the payload, clients revalidate with If-None-Match to get a 304.
+    '''
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=2.0):
+        '''
+        Initialize a ResponseCache holding at most max_bytes of payloads
+        for at most ttl seconds each
+        '''
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key -> (body, mimetype, etag, stored at)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        # Bumped for changes that show up in every payload (genres)
+        self.epoch = 0
+        # resource -> version
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def watch(self):
+        '''
+        Invalidate resources whenever a session commits changes to them
+        '''
+        @event.listens_for(Session, "after_flush")
+        def collect(session, flush_context):
+            changed = session.info.setdefault("changed_resources", set())
+            for row in session.new:
+                if isinstance(row, Genre):
+                    changed.add("genres")
+                changed.update(resources_of(row))
+            for row in list(session.dirty) + list(session.deleted):
+                # Genres are embedded in users, songs and queries, so a
+                # changed genre invalidates everything. Linking a genre
+                # only touches its collections and does not count.
+                if isinstance(row, Genre) and (
+                        row in session.deleted or
+                        session.is_modified(row, include_collections=False)):
+                    changed.add(None)
+                changed.update(resources_of(row))
+
+        @event.listens_for(Session, "after_commit")
+        def bump(session):
+            changed = session.info.pop("changed_resources", set())
+            if None in changed:
+                self.invalidate_all()
+            else:
+                self.invalidate(*(resource for resource in changed if resource))
+
+        @event.listens_for(Session, "after_rollback")
+        def discard(session):
+            session.info.pop("changed_resources", None)
+
+    def invalidate(self, *resources):
+        '''
+        Bump the version of resources
+        '''
+        with self.lock:
+            for resource in resources:
+                self.versions[resource] = self.versions.get(resource, 0) + 1
+
+    def invalidate_all(self):
+        '''
+        Bump the version of every resource
+        '''
+        with self.lock:
+            self.epoch += 1
+
+    def version(self, resource):
+        '''
+        Get the current version of a resource
+        '''
+        with self.lock:
+            return self.epoch, self.versions.get(resource, 0)
+
+    def cached(self, resource):
+        '''
+        Decorator caching a GET view, resource is formatted with the view
+        arguments, e.g. "song:{song_id}"
+        '''
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(**kwargs):
+                name = resource.format(**kwargs)
+                key = (name, self.version(name), request.query_string)
+                entry = self.lookup(key)
+                if entry is None:
+                    response = make_response(view(**kwargs))
+                    # Streamed pages are too big to be worth keeping
+                    if response.status_code != 200 or response.is_streamed:
+                        return response
+                    entry = self.store(key, response)
+                body, mimetype, etag, stored = entry
+                if request.if_none_match.contains_weak(etag):
+                    with self.lock:
+                        self.not_modified += 1
+                    response = make_response("", 304)
+                else:
+                    response = make_response(body, 200, {"Content-Type": mimetype})
+                response.set_etag(etag)
+                return response
+            return wrapper
+        return decorator
+
+    def lookup(self, key):
+        '''
+        Get an entry from the cache, or None on a miss or if it expired
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[3] > self.ttl:
+                self.bytes -= len(self.entries.pop(key)[0])
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def store(self, key, response):
+        '''
+        Add a response to the cache, evicting least recently used ones,
+        and return its entry
+        '''
+        body = response.get_data()
+        entry = (body, response.mimetype, hashlib.sha1(body).hexdigest()[:20],
+                 time.monotonic())
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[0])
+            self.entries[key] = entry
+            self.bytes += len(body)
+            while self.bytes > self.max_bytes and self.entries:
+                self.bytes -= len(self.entries.popitem(last=False)[1][0])
+        return entry
+
+    def stats(self):
+        '''
+        Get the hit ratio and memory use of the cache
+        '''
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "not_modified": self.not_modified,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,119 @@
+import argparse
+import os
+import tempfile
+import time
+
+# Production entrypoint, serving asgi.application with uvicorn
+#   python3 serve.py
+# One worker process only: the blob store's held blobs, the mood index,
+# the pinner's backlog and the response cache live in the process, and
+# several workers would evict each other's unpinned audio, pin the same
+# blobs twice and serve stale recommendations. A single process already
+# keeps hundreds of generations in flight on the async job queue.
+#
+# `python3 serve.py bench` measures how many concurrent generations one
+# process sustains, against the fake OpenAI and Pinata servers
+#   python3 serve.py bench --generations 500 --latency 2
+#   python3 serve.py bench --generations 500 --latency 2 --sync
+
+
+def upgrade_schema():
+    '''
+    Bring the database up to date before the app is imported
+    '''
+    from flask import Flask
+    import config
+    import migrations
+    from db import db
+
+    app = Flask("app")
+    app.config.from_mapping(config.database_config())
+    db.init_app(app)
+    with app.app_context():
+        migrations.upgrade(db)
+
+
+def serve(host, port):
+    '''
+    Run the ASGI app with uvicorn, in this one process
+    '''
+    import uvicorn
+
+    upgrade_schema()
+    uvicorn.run("asgi:application", host=host, port=port,
+                lifespan="off", proxy_headers=True)
+
+
+def bench(generations, latency, sync):
+    '''
+    Submit `generations` MIDI queries at once and time how long it takes
+    for all of them to finish
+    '''
+    import fake_openai
+    import fake_pinata
+
+    openai_server = fake_openai.serve(latency=latency)
+    pinata_server = fake_pinata.serve(latency=0.05)
+    scratch = tempfile.mkdtemp()
+    os.environ.update({
+        "OPENAI_BASE_URL": "http://%s:%d/v1" % openai_server.server_address,
+        "OPENAI_API_KEY": "fake",
+        "OPENAI_MAX_CONNECTIONS": str(2 * generations),
+        "OPENAI_MAX_ASYNC_CONNECTIONS": str(2 * generations),
+        "PINATA_JWT": "fake",
+        "PINATA_URL": "http://%s:%d/pinning/pinFileToIPFS"
+        % pinata_server.server_address,
+        "DATABASE_URL": "sqlite:///%s/bench.db" % scratch,
+        "NOCTURNE_BLOB_DIR": os.path.join(scratch, "blobs"),
+        "NOCTURNE_ASYNC_JOBS": "0" if sync else "1",
+        "NOCTURNE_JOB_QUEUE_SIZE": str(generations),
+        # Every query comes from one user, at once
+        "NOCTURNE_USER_GENERATION_BURST": str(generations),
+        "NOCTURNE_GENERATION_BURST": str(generations),
+    })
+    # Imported late so that the settings above are picked up
+    from app import app, jobs
+    from db import Query
+
+    client = app.test_client()
+    user = client.post("/api/users/", json={
+        "username": "bench", "email": "bench@example.com",
+        "hashed_password": "x"}).get_json()
+    start = time.perf_counter()
+    for i in range(generations):
+        client.post("/api/queries/", json={
+            "user_id": user["id"], "mood": "calm", "query": "bench %d" % i,
+            "duration": 10, "format": "midi"})
+    submitted = time.perf_counter() - start
+    with app.app_context():
+        while True:
+            finished = Query.query.filter(
+                Query.status.in_([jobs.DONE, jobs.FAILED])).count()
+            if finished == generations:
+                break
+            time.sleep(0.1)
+        failed = Query.query.filter(Query.status == jobs.FAILED).count()
+    elapsed = time.perf_counter() - start
+    print("%s jobs, %d generations at %.1f s LLM latency" % (
+        "sync" if sync else "async", generations, latency))
+    print("submitted in %.2f s, finished in %.2f s, %d failed" % (
+        submitted, elapsed, failed))
+    print("%.1f generations/s, %.0f in flight on average" % (
+        generations / elapsed, generations * latency / elapsed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subcommands = parser.add_subparsers(dest="command")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    bench_parser = subcommands.add_parser("bench")
+    bench_parser.add_argument("--generations", type=int, default=500)
+    bench_parser.add_argument("--latency", type=float, default=2.0)
+    bench_parser.add_argument("--sync", action="store_true",
+                              help="use the threaded job queue instead")
+    args = parser.parse_args()
+    if args.command == "bench":
+        bench(args.generations, args.latency, args.sync)
+    else:
+        serve(args.host, args.port)
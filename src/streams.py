@@ -0,0 +1,166 @@
+import asyncio
+import threading
+import time
+import json_response
+import note_parser
+
+# Live note streams of queries created with "stream": true. The job
+# generating a query feeds the melody into its channel as the LLM writes
+# it, and /api/queries/<id>/events/ relays every note to the client as a
+# server-sent event. Channels only exist in the process running the job.
+
+HEADERS = {
+    "Cache-Control": "no-cache",
+    # Keep nginx from buffering the stream
+    "X-Accel-Buffering": "no",
+}
+
+
+def encode(event):
+    '''
+    Encode an event from listen() as a server-sent event
+    '''
+    if event is None:
+        return b": keepalive\n\n"
+    return b"event: %s\ndata: %s\n\n" % (event[0].encode(), json_response.dumps(event[1]))
+
+
+class NoteChannel:
+    '''
+    Events of one streamed generation, kept so that a client connecting
+    late gets everything from the start
+    '''
+
+    def __init__(self):
+        '''
+        Initialize an open NoteChannel
+        '''
+        self.parser = note_parser.NoteParser()
+        self.condition = threading.Condition()
+        self.events = []
+        self.closed_at = None
+        # (event loop, asyncio.Event) of every waiting alisten()
+        self.waiters = set()
+
+    def publish(self, event, data):
+        '''
+        Send an event to every listener
+        '''
+        with self.condition:
+            self.events.append((event, data))
+            self.notify()
+
+    def notify(self):
+        '''
+        Wake every listener up, must be called with the condition held
+        '''
+        self.condition.notify_all()
+        for loop, wakeup in self.waiters:
+            loop.call_soon_threadsafe(wakeup.set)
+        self.waiters.clear()
+
+    def feed(self, chunk):
+        '''
+        Parse a chunk of the melody and publish the notes it completes
+        '''
+        known = len(self.parser.result)
+        if self.parser.feed(chunk):
+            self.publish("notes", self.parser.result.serialize(known))
+
+    def notes(self):
+        '''
+        Finish parsing and get the notes of the melody as a NoteArray
+        '''
+        return self.parser.close()
+
+    def close(self, event, data):
+        '''
+        Publish the last event and end the stream
+        '''
+        with self.condition:
+            self.events.append((event, data))
+            self.closed_at = time.monotonic()
+            self.notify()
+
+    def listen(self, keepalive=15.0):
+        '''
+        Iterate over the events from the first one until the stream ends,
+        yielding None when nothing happened for keepalive seconds
+        '''
+        position = 0
+        while True:
+            with self.condition:
+                if position == len(self.events) and self.closed_at is None:
+                    self.condition.wait(keepalive)
+                events = self.events[position:]
+                closed = self.closed_at is not None
+            if not events:
+                if closed:
+                    return
+                yield None
+                continue
+            position += len(events)
+            for event in events:
+                yield event
+
+    async def alisten(self, keepalive=15.0):
+        '''
+        listen() for asyncio, waiting without holding a thread
+        '''
+        loop = asyncio.get_running_loop()
+        position = 0
+        while True:
+            wakeup = asyncio.Event()
+            with self.condition:
+                events = self.events[position:]
+                closed = self.closed_at is not None
+                if not events and not closed:
+                    self.waiters.add((loop, wakeup))
+            if not events:
+                if closed:
+                    return
+                try:
+                    await asyncio.wait_for(wakeup.wait(), keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+                finally:
+                    with self.condition:
+                        self.waiters.discard((loop, wakeup))
+                continue
+            position += len(events)
+            for event in events:
+                yield event
+
+
+class NoteStreams:
+    '''
+    Channels of the streamed generations in this process, by query id.
+    Finished channels are dropped after linger seconds.
+    '''
+
+    def __init__(self, linger=300.0):
+        '''
+        Initialize an empty NoteStreams
+        '''
+        self.linger = linger
+        self.lock = threading.Lock()
+        self.channels = {}
+
+    def open(self, query_id):
+        '''
+        Create the channel of a query
+        '''
+        now = time.monotonic()
+        with self.lock:
+            for old_id, channel in list(self.channels.items()):
+                if channel.closed_at is not None and now - channel.closed_at > self.linger:
+                    del self.channels[old_id]
+            channel = self.channels[query_id] = NoteChannel()
+            return channel
+
+    def get(self, query_id):
+        '''
+        Get the channel of a query, or None if it is not streamed here
+        '''
+        with self.lock:
+            return self.channels.get(query_id)
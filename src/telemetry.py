@@ -0,0 +1,242 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+import config
+
+# In-process metrics, served in the Prometheus text format at /metrics.
+# Every server worker process keeps its own, so scrape each of them.
+# NOCTURNE_METRICS=0 turns recording off, observing is then a no-op.
+
+enabled = config.env_flag("NOCTURNE_METRICS", True)
+
+latency_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+count_buckets = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+registry = []
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def sample(name, labels, value):
+    '''
+    Format one sample line, labels being a tuple of (name, value) pairs
+    '''
+    if labels:
+        name += "{%s}" % ",".join(
+            '%s="%s"' % (label, escape(value)) for label, value in labels)
+    return "%s %s" % (name, repr(float(value)) if isinstance(value, float) else value)
+
+
+class Histogram:
+    '''
+    Histogram of observed values per set of labels
+    '''
+
+    def __init__(self, name, help, buckets=latency_buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # labels -> count per bucket, +Inf last, then the sum
+        self.series = {}
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        '''
+        Record one value
+        '''
+        if not enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s histogram" % self.name]
+        with self.lock:
+            series = [(key, list(values)) for key, values in self.series.items()]
+        for key, values in series:
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                total += count
+                lines.append(sample(self.name + "_bucket",
+                                    key + (("le", bound),), total))
+            lines.append(sample(self.name + "_sum", key, values[-1]))
+            lines.append(sample(self.name + "_count", key, total))
+        return lines
+
+
+class Counter:
+    '''
+    Monotonic counter per set of labels
+    '''
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.series = {}
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        '''
+        Add amount to the counter
+        '''
+        if not enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s counter" % self.name]
+        with self.lock:
+            series = list(self.series.items())
+        lines.extend(sample(self.name, key, value) for key, value in series)
+        return lines
+
+
+class Gauge:
+    '''
+    Value read from a function at scrape time
+    '''
+
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.function = function
+        registry.append(self)
+
+    def render(self):
+        return ["# HELP %s %s" % (self.name, self.help),
+                "# TYPE %s gauge" % self.name,
+                sample(self.name, (), self.function())]
+
+
+########## Metrics ##########
+
+request_seconds = Histogram(
+    "nocturne_http_request_duration_seconds",
+    "Time to handle a request, up to the first byte of streamed bodies")
+request_sql_statements = Histogram(
+    "nocturne_http_request_sql_statements",
+    "SQL statements executed per request", count_buckets)
+request_sql_seconds = Histogram(
+    "nocturne_http_request_sql_seconds",
+    "Time spent in SQL statements per request")
+sql_statements = Counter(
+    "nocturne_sql_statements_total",
+    "SQL statements executed, requests and background work alike")
+sql_seconds = Counter(
+    "nocturne_sql_seconds_total",
+    "Time spent in SQL statements")
+stage_seconds = Histogram(
+    "nocturne_query_stage_seconds",
+    "Time spent in each stage of generating a query")
+openai_requests = Counter(
+    "nocturne_openai_requests_total",
+    "OpenAI completions by kind and outcome")
+openai_tokens = Counter(
+    "nocturne_openai_tokens_total",
+    "OpenAI tokens used by kind and type")
+admission_rejections = Counter(
+    "nocturne_admission_rejections_total",
+    "Generation requests answered with a 429, by reason")
+
+
+@contextmanager
+def timer(histogram, **labels):
+    '''
+    Observe the time spent in a with block
+    '''
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+def render():
+    '''
+    Get every metric in the Prometheus text format
+    '''
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def instrument(app):
+    '''
+    Time the requests of app and the SQL statements and commits of every
+    engine and session, does nothing when metrics are disabled
+    '''
+    if not enabled:
+        return
+
+    @app.before_request
+    def start_request():
+        g.request_start = time.perf_counter()
+        g.sql_statements = 0
+        g.sql_seconds = 0.0
+
+    @app.after_request
+    def observe_request(response):
+        if "request_start" not in g:
+            return response
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        request_seconds.observe(
+            time.perf_counter() - g.request_start, method=request.method,
+            route=route, status=str(response.status_code))
+        request_sql_statements.observe(g.sql_statements, route=route)
+        request_sql_seconds.observe(g.sql_seconds, route=route)
+        return response
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("statement_start", []).append(time.perf_counter())
+
+    @event.listens_for(Engine, "after_cursor_execute")
+    def observe_statement(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["statement_start"].pop()
+        sql_statements.inc()
+        sql_seconds.inc(elapsed)
+        if has_request_context() and "sql_statements" in g:
+            g.sql_statements += 1
+            g.sql_seconds += elapsed
+
+    @event.listens_for(Engine, "handle_error")
+    def drop_statement(context):
+        if context.connection is not None:
+            starts = context.connection.info.get("statement_start")
+            if starts:
+                starts.pop()
+
+    # A commit flushes pending changes first, so this covers both
+    @event.listens_for(Session, "before_commit")
+    def start_commit(session):
+        session.info["commit_start"] = time.perf_counter()
+
+    @event.listens_for(Session, "after_commit")
+    def observe_commit(session):
+        start = session.info.pop("commit_start", None)
+        if start is not None:
+            stage_seconds.observe(time.perf_counter() - start, stage="db_commit")
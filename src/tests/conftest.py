@@ -0,0 +1,48 @@
+import os
+import sys
+import tempfile
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_openai  # noqa: E402
+import fake_pinata  # noqa: E402
+
+# The app is configured from the environment when it is imported, so point
+# it at a scratch database and blob store and at the local stand-ins for
+# OpenAI and Pinata first. Responses are not cached so that every request
+# runs its view.
+openai_server = fake_openai.serve(latency=0.05)
+pinata_server = fake_pinata.serve(latency=0.01)
+scratch = tempfile.mkdtemp(prefix="nocturne-tests-")
+os.environ.update({
+    "DATABASE_URL": "sqlite:///%s" % os.path.join(scratch, "nocturne.db"),
+    "NOCTURNE_BLOB_DIR": os.path.join(scratch, "blobs"),
+    "NOCTURNE_FAKE_SYNTH": "1",
+    "NOCTURNE_RENDER_WORKERS": "1",
+    "NOCTURNE_RESPONSE_CACHE_BYTES": "0",
+    "NOCTURNE_PREGEN_INTERVAL": "0",
+    "NOCTURNE_PIN_INTERVAL": "0.1",
+    "NOCTURNE_METRICS": "1",
+    "OPENAI_API_KEY": "fake",
+    "OPENAI_BASE_URL": "http://%s:%d/v1" % openai_server.server_address,
+    "PINATA_JWT": "fake",
+    "PINATA_URL": "http://%s:%d/pinning/pinFileToIPFS" % pinata_server.server_address,
+})
+
+
+@pytest.fixture(scope="session")
+def app():
+    import app as nocturne
+    return nocturne.app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def db(app):
+    from db import db
+    with app.app_context():
+        yield db
@@ -0,0 +1,116 @@
+import queue
+import threading
+import pytest
+import admission
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    return now
+
+
+def admitter(in_flight=0, **kwargs):
+    settings = {"user_rate": 0.5, "user_burst": 2, "global_rate": 10,
+                "global_burst": 100, "max_in_flight": 10,
+                "in_flight": lambda: in_flight, "retry_after": 5.0}
+    return admission.Admission(**{**settings, **kwargs})
+
+
+def test_fair_queue_serves_keys_in_turn():
+    pending = admission.FairQueue()
+    for item in ["a1", "a2", "a3", "a4"]:
+        pending.put_nowait("a", item)
+    for item in ["b1", "b2"]:
+        pending.put_nowait("b", item)
+    pending.put_nowait("c", "c1")
+    order = [pending.get_nowait() for _ in range(pending.qsize())]
+    assert order == ["a1", "b1", "c1", "a2", "b2", "a3", "a4"]
+    assert pending.key_count() == 0
+
+
+def test_fair_queue_new_key_waits_for_its_turn():
+    pending = admission.FairQueue()
+    pending.put_nowait("a", "a1")
+    pending.put_nowait("a", "a2")
+    pending.put_nowait("b", "b1")
+    assert pending.get_nowait() == "a1"
+    # "a" went to the back of the line behind "b"
+    pending.put_nowait("c", "c1")
+    assert [pending.get_nowait() for _ in range(3)] == ["b1", "a2", "c1"]
+
+
+def test_fair_queue_bounds():
+    pending = admission.FairQueue(maxsize=2)
+    pending.put_nowait("a", 1)
+    pending.put_nowait("b", 2)
+    with pytest.raises(queue.Full):
+        pending.put_nowait("c", 3)
+    pending.get_nowait()
+    pending.get_nowait()
+    with pytest.raises(queue.Empty):
+        pending.get_nowait()
+
+
+def test_fair_queue_get_waits_for_an_item():
+    pending = admission.FairQueue()
+    got = []
+    consumer = threading.Thread(target=lambda: got.append(pending.get()))
+    consumer.start()
+    pending.put_nowait("a", "item")
+    consumer.join(5)
+    assert got == ["item"]
+
+
+def test_user_rate(clock):
+    admissions = admitter()
+    assert admissions.admit(1) is None
+    assert admissions.admit(1) is None
+    # Out of burst, the next token comes in 1 / 0.5 seconds
+    assert admissions.admit(1) == ("user_rate", 2.0)
+    clock[0] += 1.5
+    assert admissions.admit(1) == ("user_rate", pytest.approx(0.5))
+    # Other users have their own bucket
+    assert admissions.admit(2) is None
+    clock[0] += 0.5
+    assert admissions.admit(1) is None
+    assert admissions.stats()["admitted"] == 4
+    assert admissions.stats()["rejected"]["user_rate"] == 2
+
+
+def test_global_rate(clock):
+    admissions = admitter(global_rate=2, global_burst=3)
+    assert [admissions.admit(user_id) for user_id in range(3)] == [None] * 3
+    assert admissions.admit(3) == ("global_rate", 0.5)
+    # Rejected requests do not use up tokens
+    clock[0] += 0.5
+    assert admissions.admit(3) is None
+
+
+def test_in_flight_cap(clock):
+    admissions = admitter(in_flight=10, retry_after=7.0)
+    assert admissions.admit(1) == ("in_flight", 7.0)
+    assert admissions.stats()["rejected"]["in_flight"] == 1
+
+
+def test_full_buckets_are_forgotten(clock):
+    admissions = admitter(max_users=2)
+    admissions.admit(1)
+    admissions.admit(1)
+    admissions.admit(2)
+    clock[0] += 2
+    # 2 is back to a full burst, 1 has only one token back
+    admissions.admit(3)
+    assert sorted(admissions.user_buckets) == [1, 3]
+    assert admissions.admit(1) is None
+    assert admissions.admit(1) == ("user_rate", 2.0)
+
+
+@pytest.mark.parametrize("wait, header", [(0.2, "1"), (1.0, "1"), (2.1, "3")])
+def test_retry_after_header(app, wait, header):
+    import app as nocturne
+    with app.test_request_context():
+        response = nocturne.too_many_requests("slow down", wait)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == header
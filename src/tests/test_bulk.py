@@ -0,0 +1,27 @@
+import threading
+from db import Genre
+
+
+def test_concurrent_bulk_inserts(app, client, db):
+    '''
+    Bulk requests racing for the same ids all succeed, SQLite ones take
+    the write lock before reading the largest id
+    '''
+    before = db.session.query(Genre).count()
+    statuses = []
+
+    def post(n):
+        response = app.test_client().post("/api/genres/bulk/", json=[
+            {"genre": "bulk %d %d" % (n, i)} for i in range(200)])
+        statuses.append((response.status_code, response.json.get("created")))
+
+    threads = [threading.Thread(target=post, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert statuses == [(200, 200)] * 8
+    assert db.session.query(Genre).count() == before + 1600
+    db.session.query(Genre).filter(Genre.genre.like("bulk %")).delete(
+        synchronize_session=False)
+    db.session.commit()
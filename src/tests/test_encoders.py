@@ -0,0 +1,41 @@
+import os
+import threading
+import encoders
+
+
+def stand_in(tmp_path, monkeypatch, script):
+    '''
+    Point the encoder at a shell script instead of ffmpeg
+    '''
+    path = tmp_path / "ffmpeg"
+    path.write_text("#!/bin/sh\n" + script + "\n")
+    path.chmod(0o755)
+    monkeypatch.setattr(encoders, "ffmpeg", str(path))
+
+
+def test_encode_streams_the_encoder_output(tmp_path, monkeypatch):
+    stand_in(tmp_path, monkeypatch, "exec cat")
+    data = os.urandom(3 << 20)
+    assert b"".join(encoders.encode(data, "flac")) == data
+
+
+def test_encode_reports_encoder_errors(tmp_path, monkeypatch):
+    stand_in(tmp_path, monkeypatch, "echo bad input >&2; exit 1")
+    try:
+        list(encoders.encode(b"RIFF", "flac"))
+    except encoders.EncodeError as e:
+        assert str(e) == "bad input"
+    else:
+        assert False, "expected an EncodeError"
+
+
+def test_closing_early_stops_the_encoder(tmp_path, monkeypatch):
+    # The encoder fills its stdout pipe and stops reading stdin once
+    # nobody reads its output
+    stand_in(tmp_path, monkeypatch, "exec cat")
+    chunks = encoders.encode(b"x" * (50 << 20), "flac")
+    next(chunks)
+    closer = threading.Thread(target=chunks.close, daemon=True)
+    closer.start()
+    closer.join(10)
+    assert not closer.is_alive()
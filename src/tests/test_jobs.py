@@ -0,0 +1,144 @@
+import time
+import pytest
+from sqlalchemy import event
+import gpt4_querier
+import jobs
+from db import Query, User
+
+# The generate -> render -> pin pipeline against the fake OpenAI and
+# Pinata servers started by conftest
+
+
+@pytest.fixture(scope="module")
+def nocturne(app):
+    import app as nocturne
+    return nocturne
+
+
+@pytest.fixture
+def user_id(db):
+    user = User(username="jobs", email="jobs@example.com", hashed_password="x")
+    db.session.add(user)
+    db.session.commit()
+    yield user.id
+    db.session.delete(db.session.get(User, user.id))
+    db.session.commit()
+
+
+def new_query(db, user_id, **kwargs):
+    query = Query(query="a calm song", user_id=user_id, mood="calm", **kwargs)
+    db.session.add(query)
+    db.session.commit()
+    return query.id
+
+
+def run(nocturne, db, query_id):
+    '''
+    Run the pipeline for a query on this thread, returning every status
+    it was committed with
+    '''
+    statuses = [db.session.get(Query, query_id).status]
+
+    def record(session, context, instances):
+        for row in session.dirty:
+            if isinstance(row, Query) and row.id == query_id:
+                statuses.append(row.status)
+
+    event.listen(db.session, "before_flush", record)
+    try:
+        nocturne.job_queue.run(query_id)
+    finally:
+        event.remove(db.session, "before_flush", record)
+    return statuses
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def test_stages(nocturne, db, user_id):
+    query_id = new_query(db, user_id)
+    assert run(nocturne, db, query_id) == [
+        jobs.PENDING, jobs.GENERATING, jobs.RENDERING, jobs.DONE]
+    db.session.expire_all()
+    query = db.session.get(Query, query_id)
+    assert query.title == "Nocturne"
+    assert not query.error
+    assert next(nocturne.blobs.read(query.blob_hash)).startswith(b"RIFF")
+    assert query.generating_time > 0 and query.rendering_time > 0
+
+
+def test_generation_failure(nocturne, db, user_id, monkeypatch):
+    from conftest import openai_server
+    monkeypatch.setattr(openai_server, "error_rate", 1.0)
+    monkeypatch.setattr(gpt4_querier, "max_attempts", 1)
+    query_id = new_query(db, user_id)
+    assert run(nocturne, db, query_id) == [
+        jobs.PENDING, jobs.GENERATING, jobs.FAILED]
+    db.session.expire_all()
+    query = db.session.get(Query, query_id)
+    assert query.blob_hash is None
+    assert query.error
+
+
+def test_render_failure(nocturne, db, user_id, monkeypatch):
+    def crash(notes):
+        raise RuntimeError("synth crashed")
+
+    monkeypatch.setattr(nocturne.renderers, "render", crash)
+    query_id = new_query(db, user_id)
+    assert run(nocturne, db, query_id) == [
+        jobs.PENDING, jobs.GENERATING, jobs.RENDERING, jobs.FAILED]
+    db.session.expire_all()
+    assert db.session.get(Query, query_id).error == "synth crashed"
+
+
+def test_query_is_generated_and_pinned(nocturne, client, db, user_id):
+    response = client.post("/api/queries/", json={
+        "query": "a song for the rain", "user_id": user_id, "mood": "sad"})
+    assert response.status_code == 202
+    query_id = response.json["id"]
+
+    def status():
+        return client.get("/api/queries/%d/status/" % query_id).json
+
+    wait_for(lambda: status()["status"] in (jobs.DONE, jobs.FAILED))
+    assert status()["status"] == jobs.DONE
+    assert client.get("/api/queries/%d/audio/" % query_id).status_code == 200
+
+    def pinned():
+        db.session.expire_all()
+        return db.session.get(Query, query_id).pinata_url
+    wait_for(pinned)
+    assert pinned().startswith("ipfs.io/ipfs/bafk")
+
+
+@pytest.mark.parametrize("duration", ["abc", 10.5, True, 0, 601, 10 ** 9])
+def test_invalid_duration(client, user_id, duration):
+    response = client.post("/api/queries/", json={
+        "query": "a song", "user_id": user_id, "duration": duration})
+    assert response.status_code == 400
+
+
+def test_pin_given_up_drops_cached_variant(nocturne, db, user_id, monkeypatch):
+    import generation_cache
+    import pinata_integration
+
+    query_id = new_query(db, user_id)
+    nocturne.job_queue.run(query_id)
+    query = db.session.get(Query, query_id)
+    cache = generation_cache.GenerationCache()
+    key = generation_cache.make_key(query.mood, [], query.text, query.duration)
+    cache.put(key, "[]", query.title, query.blob_hash, None)
+    pinner = jobs.Pinner(nocturne.app, nocturne.blobs, max_attempts=1, cache=cache)
+
+    def fail(*args):
+        raise pinata_integration.UploadError("rejected")
+
+    monkeypatch.setattr(pinata_integration, "upload_pinata_stream", fail)
+    pinner.pin([query_id])
+    assert cache.get(key) is None
+    assert cache.stats()["keys"] == 0
@@ -0,0 +1,116 @@
+import math
+import random
+import pytest
+import mood_index
+import moods
+
+WORDS = list(moods.LEXICON) + ["calm and happy", "sad/tired", "anxious but hopeful"]
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    '''
+    500 songs with random moods and up to two of five genres, as
+    song id -> (point, genre ids)
+    '''
+    rng = random.Random(0)
+    songs = {}
+    for song_id in range(1, 501):
+        mood = rng.choice(WORDS)
+        songs[song_id] = (mood, rng.sample(range(1, 6), rng.randint(0, 2)))
+    return songs
+
+
+@pytest.fixture
+def index(catalog):
+    index = mood_index.MoodIndex()
+    for song_id, (mood, genre_ids) in catalog.items():
+        index.add(song_id, mood, genre_ids)
+    return index
+
+
+def brute_force(catalog, x, y, k, genre_id=None, exclude=None):
+    '''
+    Distances of the k nearest songs, by scanning every song
+    '''
+    distances = sorted(
+        math.dist((x, y), moods.mood_vector(mood))
+        for song_id, (mood, genre_ids) in catalog.items()
+        if song_id != exclude and (genre_id is None or genre_id in genre_ids))
+    return distances[:k]
+
+
+def distances(index, song_ids, x, y):
+    return [math.dist((x, y), index.vector(song_id)) for song_id in song_ids]
+
+
+@pytest.mark.parametrize("genre_id", [None, 1, 5])
+@pytest.mark.parametrize("k", [1, 10, 100])
+def test_nearest_matches_brute_force(catalog, index, k, genre_id):
+    rng = random.Random(k)
+    for _ in range(50):
+        # Also from outside the mood grid, where the first rings are empty
+        x, y = rng.uniform(-10, 10), rng.uniform(-10, 10)
+        song_ids = index.nearest(x, y, k, genre_id=genre_id)
+        assert distances(index, song_ids, x, y) == pytest.approx(
+            brute_force(catalog, x, y, k, genre_id))
+        if genre_id is not None:
+            assert all(genre_id in catalog[song_id][1] for song_id in song_ids)
+
+
+@pytest.mark.parametrize("genre_id", [None, 2])
+def test_nearest_excludes_the_seed_song(catalog, index, genre_id):
+    for song_id in [1, 2, 3, 250, 500]:
+        x, y = index.vector(song_id)
+        song_ids = index.nearest(x, y, 10, genre_id=genre_id, exclude=song_id)
+        assert song_id not in song_ids
+        assert distances(index, song_ids, x, y) == pytest.approx(
+            brute_force(catalog, x, y, 10, genre_id, exclude=song_id))
+
+
+def test_exclude_does_not_end_the_search_early():
+    # The only song in the first ring is the excluded one, the answer is
+    # further out
+    index = mood_index.MoodIndex()
+    index.add(1, "calm")
+    index.add(2, "enraged")
+    x, y = index.vector(1)
+    assert index.nearest(x, y, 1, exclude=1) == [2]
+
+
+def test_fewer_songs_than_k(index):
+    assert len(index.nearest(0, 0, 1000)) == 500
+    assert index.nearest(0, 0, 0) == []
+    assert mood_index.MoodIndex().nearest(0, 0, 10) == []
+
+
+def test_unknown_moods_are_not_indexed():
+    index = mood_index.MoodIndex()
+    index.add(1, "blorp")
+    index.add(2, "calm")
+    assert index.vector(1) is None
+    assert index.nearest(0, 0, 10) == [2]
+
+
+def test_update_and_remove():
+    index = mood_index.MoodIndex()
+    index.add(1, "calm", [1])
+    index.add(1, "enraged", [2])
+    assert index.vector(1) == tuple(moods.mood_vector("enraged"))
+    assert index.nearest(0, 0, 10, genre_id=1) == []
+    assert index.nearest(0, 0, 10, genre_id=2) == [1]
+    index.remove(1)
+    index.remove(1)
+    assert index.nearest(0, 0, 10) == []
+    assert index.cells == {}
+
+
+def test_remove_genre():
+    index = mood_index.MoodIndex()
+    index.add(1, "calm", [1, 2])
+    index.remove_genre(1)
+    assert index.nearest(0, 0, 10, genre_id=1) == []
+    assert index.nearest(0, 0, 10, genre_id=2) == [1]
+    # Removing the song afterwards only touches the genres it still has
+    index.remove(1)
+    assert index.cells == {}
@@ -0,0 +1,73 @@
+import pytest
+import note_parser
+
+NOTE = "{'note': 60, 'start_time': 0.0, 'duration': 0.5, 'velocity': 100}"
+OTHER = "{'note': 64, 'start_time': 0.5, 'duration': 1, 'velocity': 90}"
+EXPECTED = [(60, 0.0, 0.5, 100), (64, 0.5, 1.0, 90)]
+
+
+def notes(text):
+    return list(note_parser.parse(text))
+
+
+def test_python_literal():
+    assert notes("[%s, %s]" % (NOTE, OTHER)) == EXPECTED
+
+
+def test_json_quoting():
+    assert notes('[{"note": 60, "start_time": 0.0, "duration": 0.5, "velocity": 100},'
+                 ' {"note": 64, "start_time": 0.5, "duration": 1, "velocity": 90}]'
+                 ) == EXPECTED
+
+
+def test_code_fence_and_chatter():
+    assert notes("Here is your melody:\n```python\n[\n%s,\n%s\n]\n```\nEnjoy!" % (
+        NOTE, OTHER)) == EXPECTED
+
+
+def test_trailing_comma():
+    assert notes("[%s, %s,]" % (NOTE, OTHER)) == EXPECTED
+
+
+def test_truncated_last_entry_is_dropped():
+    parser = note_parser.NoteParser()
+    parser.feed("[%s, %s, {'note': 67, 'start_ti" % (NOTE, OTHER))
+    assert list(parser.close()) == EXPECTED
+    assert parser.errors == ["dropped truncated final note"]
+
+
+def test_fed_in_chunks():
+    parser = note_parser.NoteParser()
+    text = "[%s, %s]" % (NOTE, OTHER)
+    counts = [parser.feed(text[start:start + 7]) for start in range(0, len(text), 7)]
+    assert sum(counts) == 2
+    assert list(parser.close()) == EXPECTED
+
+
+@pytest.mark.parametrize("entry, error", [
+    ("{'note': 128, 'start_time': 0, 'duration': 1, 'velocity': 100}",
+     "note out of range"),
+    ("{'note': -1, 'start_time': 0, 'duration': 1, 'velocity': 100}",
+     "note out of range"),
+    ("{'note': 60, 'start_time': 0, 'duration': 1, 'velocity': 300}",
+     "velocity out of range"),
+    ("{'note': 60, 'start_time': -1, 'duration': 1, 'velocity': 100}",
+     "negative time"),
+    ("{'note': 60, 'start_time': 1199, 'duration': 2, 'velocity': 100}",
+     "note ends after beat 1200"),
+    ("{'note': 60, 'start_time': 1e400, 'duration': 1, 'velocity': 100}",
+     "non-finite value"),
+    ("{'note': 1e400, 'start_time': 0, 'duration': 1, 'velocity': 100}",
+     "non-finite value"),
+    ("{'note': 60, 'duration': 1, 'velocity': 100}", "missing 'start_time'"),
+])
+def test_invalid_note_is_skipped(entry, error):
+    parser = note_parser.NoteParser()
+    parser.feed("[%s, %s, %s]" % (NOTE, entry, OTHER))
+    assert list(parser.close()) == EXPECTED
+    assert parser.errors == ["%s in %s" % (error, entry)]
+
+
+def test_no_valid_notes():
+    with pytest.raises(note_parser.NoteParseError):
+        note_parser.parse("I can't write music, sorry")
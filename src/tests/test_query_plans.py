@@ -0,0 +1,136 @@
+import types
+import pytest
+from sqlalchemy import create_engine, event, select, text
+from db import User, Query, Song
+from db import association_table2, association_table5, association_table8
+import migrations
+
+# Every hot lookup must be answered from an index, both in a database
+# created from the models and in one upgraded from before versioning
+
+# Schema of nocturne.db files from before the migrations
+BASELINE_SCHEMA = """
+CREATE TABLE users (
+    id INTEGER NOT NULL, username VARCHAR(80) NOT NULL,
+    email VARCHAR(120) NOT NULL, hashed_password VARCHAR(120) NOT NULL,
+    PRIMARY KEY (id));
+CREATE TABLE genres (id INTEGER NOT NULL, genre VARCHAR(80), PRIMARY KEY (id));
+CREATE TABLE user_genre_association (
+    user_id INTEGER, genre_id INTEGER,
+    FOREIGN KEY(user_id) REFERENCES users (id),
+    FOREIGN KEY(genre_id) REFERENCES genres (id));
+CREATE TABLE songs (
+    id INTEGER NOT NULL, title VARCHAR(80) NOT NULL, likes INTEGER NOT NULL,
+    user_id INTEGER NOT NULL, mood VARCHAR(80),
+    PRIMARY KEY (id), FOREIGN KEY(user_id) REFERENCES users (id));
+CREATE TABLE queries (
+    id INTEGER NOT NULL, text VARCHAR(80), user_id INTEGER NOT NULL,
+    mood VARCHAR(80), pinata_url VARCHAR,
+    PRIMARY KEY (id), FOREIGN KEY(user_id) REFERENCES users (id));
+CREATE TABLE query_genre_association (
+    query_id INTEGER, genre_id INTEGER,
+    FOREIGN KEY(query_id) REFERENCES queries (id),
+    FOREIGN KEY(genre_id) REFERENCES genres (id));
+CREATE TABLE song_genre_association (
+    song_id INTEGER, genre_id INTEGER,
+    FOREIGN KEY(song_id) REFERENCES songs (id),
+    FOREIGN KEY(genre_id) REFERENCES genres (id));
+"""
+
+# Lookup -> index it must use. Association tables are searched by owner
+# through their primary key and by genre through their genre_id index.
+LOOKUPS = [
+    (select(Song.id).where(Song.user_id.in_([1, 2])), "ix_songs_user_id"),
+    (select(Query.id).where(Query.user_id.in_([1, 2])), "ix_queries_user_id"),
+    (select(User.id).where(User.email == "someone@example.com"), "ix_users_email"),
+] + [
+    lookup for table, owner in [
+        (association_table2, "user_id"),
+        (association_table5, "query_id"),
+        (association_table8, "song_id"),
+    ] for lookup in [
+        (select(table.c.genre_id).where(table.c[owner].in_([1, 2])),
+         "sqlite_autoindex_%s_1" % table.name),
+        (select(table.c[owner]).where(table.c.genre_id == 1),
+         "ix_%s_genre_id" % table.name),
+    ]
+]
+
+
+def plan(conn, statement, parameters=()):
+    '''
+    Get the EXPLAIN QUERY PLAN details of a statement as one string
+    '''
+    rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)
+    return "\n".join(row[-1] for row in rows)
+
+
+def compiled(conn, statement):
+    return str(statement.compile(conn, compile_kwargs={"literal_binds": True}))
+
+
+@pytest.fixture(scope="module")
+def created(app):
+    from db import db
+    with app.app_context():
+        with db.engine.connect() as conn:
+            yield conn
+
+
+@pytest.fixture(scope="module")
+def migrated(app, tmp_path_factory):
+    from db import db
+    engine = create_engine("sqlite:///%s" % tmp_path_factory.mktemp("baseline").joinpath(
+        "nocturne.db"))
+    with engine.begin() as conn:
+        for statement in BASELINE_SCHEMA.split(";"):
+            if statement.strip():
+                conn.execute(text(statement))
+    migrations.upgrade(types.SimpleNamespace(engine=engine, metadata=db.metadata))
+    with engine.connect() as conn:
+        yield conn
+    engine.dispose()
+
+
+@pytest.mark.parametrize("schema", ["created", "migrated"])
+@pytest.mark.parametrize("statement, index", LOOKUPS,
+                         ids=[index for statement, index in LOOKUPS])
+def test_lookup_uses_index(request, schema, statement, index):
+    conn = request.getfixturevalue(schema)
+    details = plan(conn, compiled(conn, statement))
+    assert index in details, details
+
+
+def test_relationship_loads_use_indexes(app, client, created):
+    '''
+    The selectin loads serializing a user search every child table by
+    index instead of scanning it
+    '''
+    from db import db
+
+    with app.app_context():
+        user = User(username="plans", email="plans@example.com", hashed_password="x")
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+    executed = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("SELECT"):
+            executed.append((statement, parameters))
+
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", capture)
+        try:
+            assert client.get("/api/users/%d/" % user_id).status_code == 200
+        finally:
+            event.remove(db.engine, "before_cursor_execute", capture)
+            db.session.delete(db.session.get(User, user_id))
+            db.session.commit()
+    assert len(executed) > 1
+    for statement, parameters in executed:
+        details = plan(created, statement, parameters)
+        for line in details.splitlines():
+            # A SCAN without an index reads the whole table
+            assert not (line.startswith("SCAN") and "INDEX" not in line), (
+                statement, details)
@@ -0,0 +1,31 @@
+import os
+import pytest
+from concurrent.futures.process import BrokenProcessPool
+import note_parser
+import renderer
+
+MELODY = "[{'note': 60, 'start_time': 0, 'duration': 1, 'velocity': 100}]"
+
+
+@pytest.fixture
+def pool():
+    pool = renderer.RendererPool(workers=1)
+    yield pool
+    pool.executor.shutdown()
+
+
+def test_render(pool):
+    audio = pool.render(note_parser.parse(MELODY))
+    assert audio.startswith(b"RIFF")
+    assert pool.stats()["rendered"] == 1
+
+
+def test_crashed_synth_process_is_replaced(pool):
+    pool.render(MELODY)
+    # Kill the synth process the way a segfault would
+    pool.executor.submit(os._exit, 1)
+    with pytest.raises(BrokenProcessPool):
+        while True:
+            pool.render(MELODY)
+    assert pool.render(MELODY).startswith(b"RIFF")
+    assert pool.stats()["restarts"] == 1
@@ -0,0 +1,168 @@
+import pytest
+from flask import Flask
+import response_cache
+from db import Genre, Song, User
+
+
+@pytest.fixture(scope="module")
+def responses(app):
+    '''
+    The app's cache, watching every session commit
+    '''
+    import app as nocturne
+    return nocturne.responses
+
+
+@pytest.fixture
+def user(db):
+    user = User(username="cache", email="cache@example.com", hashed_password="x")
+    db.session.add(user)
+    db.session.commit()
+    yield user
+    db.session.delete(db.session.get(User, user.id))
+    db.session.commit()
+
+
+def versions(responses, *resources):
+    return [responses.version(resource) for resource in resources]
+
+
+def test_commit_bumps_the_resources_of_a_row(responses, db, user):
+    song = Song(title="cached", user_id=user.id, mood="calm")
+    db.session.add(song)
+    db.session.flush()
+    resources = ["songs", "song:%d" % song.id, "users", "user:%d" % user.id]
+    before = versions(responses, *resources + ["queries", "genres"])
+    db.session.commit()
+    after = versions(responses, *resources + ["queries", "genres"])
+    for (epoch, version), (new_epoch, new_version) in zip(before[:4], after[:4]):
+        assert (new_epoch, new_version) == (epoch, version + 1)
+    # Unrelated resources keep their version
+    assert after[4:] == before[4:]
+
+
+def test_rollback_bumps_nothing(responses, db, user):
+    before = versions(responses, "songs", "users", "user:%d" % user.id)
+    db.session.add(Song(title="rolled back", user_id=user.id))
+    db.session.flush()
+    db.session.rollback()
+    db.session.commit()
+    assert versions(responses, "songs", "users", "user:%d" % user.id) == before
+
+
+def test_genres(responses, db, user):
+    epoch, genres = responses.version("genres")
+    genre = Genre(genre="cached genre")
+    db.session.add(genre)
+    db.session.commit()
+    # A new genre is in no other payload yet
+    assert responses.version("genres") == (epoch, genres + 1)
+
+    # Linking one only changes the payloads of the linked song
+    song = Song(title="linked", user_id=user.id, genres=[genre])
+    db.session.add(song)
+    db.session.commit()
+    assert responses.version("genres")[0] == epoch
+    song.genres.remove(genre)
+    db.session.commit()
+    assert responses.version("genres")[0] == epoch
+
+    # Renaming or deleting one changes every payload embedding it
+    genre.genre = "renamed genre"
+    db.session.commit()
+    assert responses.version("genres")[0] == epoch + 1
+    db.session.delete(genre)
+    db.session.commit()
+    assert responses.version("genres")[0] == epoch + 2
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def cached_app():
+    '''
+    A small app with one cached view counting its calls
+    '''
+    app = Flask(__name__)
+    # Payloads are about 20 bytes, two of them fit
+    cache = response_cache.ResponseCache(max_bytes=50, ttl=2.0)
+    calls = []
+
+    @app.route("/items/<int:item_id>/")
+    @cache.cached("item:{item_id}")
+    def get_item(item_id):
+        calls.append(item_id)
+        if item_id == 404:
+            return {"error": "not found"}, 404
+        return {"id": item_id, "calls": len(calls)}
+
+    app.cache = cache
+    app.calls = calls
+    return app
+
+
+def test_hit_and_invalidate(cached_app, clock):
+    client = cached_app.test_client()
+    first = client.get("/items/1/")
+    assert client.get("/items/1/").get_data() == first.get_data()
+    assert cached_app.calls == [1]
+    cached_app.cache.invalidate("item:1")
+    assert client.get("/items/1/").json == {"id": 1, "calls": 2}
+    cached_app.cache.invalidate_all()
+    assert client.get("/items/1/").json == {"id": 1, "calls": 3}
+    assert cached_app.cache.stats()["hits"] == 1
+
+
+def test_entries_expire_after_ttl(cached_app, clock):
+    client = cached_app.test_client()
+    client.get("/items/1/")
+    clock[0] += 2.0
+    client.get("/items/1/")
+    assert cached_app.calls == [1]
+    clock[0] += 0.1
+    client.get("/items/1/")
+    assert cached_app.calls == [1, 1]
+
+
+def test_etag_revalidation(cached_app, clock):
+    client = cached_app.test_client()
+    first = client.get("/items/1/")
+    etag = first.headers["ETag"]
+    revalidated = client.get("/items/1/", headers={"If-None-Match": etag})
+    assert revalidated.status_code == 304
+    assert revalidated.headers["ETag"] == etag
+    # The ETag is a hash of the payload, an unchanged payload keeps it
+    # across invalidations and expiry
+    cached_app.cache.invalidate("item:1")
+    cached_app.calls.clear()
+    clock[0] += 10
+    assert client.get("/items/1/", headers={"If-None-Match": etag}).status_code == 304
+    changed = client.get("/items/1/", headers={"If-None-Match": '"other"'})
+    assert changed.status_code == 200
+    assert cached_app.cache.stats()["not_modified"] == 2
+
+
+def test_errors_are_not_cached(cached_app, clock):
+    client = cached_app.test_client()
+    assert client.get("/items/404/").status_code == 404
+    assert client.get("/items/404/").status_code == 404
+    assert cached_app.calls == [404, 404]
+    assert cached_app.cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_are_evicted(cached_app, clock):
+    client = cached_app.test_client()
+    for item_id in [1, 2, 1, 3]:
+        client.get("/items/%d/" % item_id)
+    assert cached_app.calls == [1, 2, 3]
+    stats = cached_app.cache.stats()
+    assert stats["entries"] == 2 and stats["bytes"] <= 50
+    # 1 was used after 2, so 2 went first
+    client.get("/items/1/")
+    client.get("/items/2/")
+    assert cached_app.calls == [1, 2, 3, 2]
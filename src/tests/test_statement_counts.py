@@ -0,0 +1,93 @@
+import pytest
+from flask import g
+from db import User, Genre, Query, Song
+
+# Every endpoint serializing rows and their relationships must run the same
+# number of SQL statements however many rows it serializes, a statement per
+# row (N+1) shows up as a count growing with the data
+
+ENDPOINTS = [
+    "/api/users/",
+    "/api/users/1/",
+    "/api/songs/",
+    "/api/songs/1/",
+    "/api/queries/",
+    "/api/queries/1/",
+    "/api/genres/",
+    "/api/genres/1/",
+    "/api/songs/?user_id=1",
+    "/api/queries/?user_id=1",
+    "/api/users/?genre_id=1",
+]
+# Users in the database at each measurement, the largest still fits one page
+SIZES = [2, 10, 40]
+songs_per_user = 3
+queries_per_user = 2
+
+
+def grow(db, users):
+    '''
+    Add users, each with songs, queries and genres, until there are
+    `users` of them
+    '''
+    genres = Genre.query.order_by(Genre.id).all()
+    while len(genres) < 5:
+        genres.append(Genre(genre="genre %d" % len(genres)))
+        db.session.add(genres[-1])
+    for number in range(User.query.count(), users):
+        user = User(username="user%d" % number, email="user%d@example.com" % number,
+                    hashed_password="x")
+        user.genres = genres[number % 5:number % 5 + 2]
+        db.session.add(user)
+        db.session.flush()
+        for i in range(songs_per_user):
+            db.session.add(Song(title="song %d-%d" % (number, i), likes=i,
+                                user_id=user.id, mood="calm",
+                                genres=genres[i:i + 2]))
+        for i in range(queries_per_user):
+            db.session.add(Query(query="query %d-%d" % (number, i), user_id=user.id,
+                                 mood="calm", genres=genres[i:i + 1], status="done"))
+    db.session.commit()
+
+
+def statements(client, path):
+    '''
+    Get the number of SQL statements a GET request runs, as counted by
+    telemetry
+    '''
+    # The request context, and g with it, outlives the request inside the
+    # with block
+    with client:
+        response = client.get(path)
+        response.get_data()
+        assert response.status_code == 200, response.get_data()
+        return g.sql_statements
+
+
+@pytest.fixture(scope="module")
+def counts(app):
+    '''
+    Statements run by every endpoint at every size of the dataset
+    '''
+    from db import db
+
+    client = app.test_client()
+    counts = {path: [] for path in ENDPOINTS}
+    for size in SIZES:
+        with app.app_context():
+            grow(db, size)
+        for path in ENDPOINTS:
+            counts[path].append(statements(client, path))
+    return counts
+
+
+@pytest.mark.parametrize("path", ENDPOINTS)
+def test_statements_do_not_grow_with_data(counts, path):
+    assert len(set(counts[path])) == 1, "%s ran %s statements at %s users" % (
+        path, counts[path], SIZES)
+
+
+@pytest.mark.parametrize("path", ENDPOINTS)
+def test_statements_are_few(counts, path):
+    # One per table in the serialized graph at most, plus the page itself
+    assert counts[path][0] <= 6, "%s ran %d statements" % (path, counts[path][0])